@@ -22,6 +22,9 @@ const BYTE_LIMIT_FR_ONLY = 32000;
 
 // 軽いネットワーク用の最小リトライ
 const RETRY_MAX_FR_ONLY  = 1;
+// match-api 混雑時（429）に Retry-After に従って待つ回数・1 回の最大待ち
+const BUSY_RETRY_MAX_FR_ONLY = 6;
+const BUSY_WAIT_CAP_MS_FR_ONLY = 30000;
 
 
 /* ==== メイン処理 ==== */
@@ -177,16 +180,29 @@ function safeFetchMatch_FR_FAST_(fullName, profileTxt) {
   const base = {
     method: 'post',
     contentType: 'application/json',
+    headers: { 'X-Priority': 'batch' },
     payload: wrap(fullName, txt),
     muteHttpExceptions: true,
   };
 
-  // ③ 最小リトライ（瞬断/500のみ）
+  // ③ 最小リトライ（瞬断/500のみ）。429 は Retry-After だけ待って同じ試行をやり直す
   let lastErr = null;
+  let busy = 0;
   for (let i = 0; i < RETRY_MAX_FR_ONLY; i++) {
     try {
       const res = UrlFetchApp.fetch(MATCH_URL_FR_ONLY, base);
       const code = res.getResponseCode();
+      if (code === 429 && busy < BUSY_RETRY_MAX_FR_ONLY) {
+        const headers = res.getAllHeaders ? res.getAllHeaders() : {};
+        const retryAfter = parseFloat(headers['Retry-After'] || headers['retry-after']);
+        const ms = retryAfter > 0
+          ? Math.min(BUSY_WAIT_CAP_MS_FR_ONLY, Math.ceil(retryAfter * 1000))
+          : Math.min(BUSY_WAIT_CAP_MS_FR_ONLY, 1000 * Math.pow(2, busy));
+        busy++;
+        i--;   // 混雑待ちは RETRY_MAX_FR_ONLY に数えない
+        Utilities.sleep(ms);
+        continue;
+      }
       if (code >= 400) throw new Error(`Match API ${code}: ${res.getContentText().slice(0, 180)}`);
       return JSON.parse(res.getContentText());
     } catch (e) {
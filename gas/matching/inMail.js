@@ -446,7 +446,7 @@ function _runBatchScoutMatching() {
       let data;
 
       if (USE_MATCH_API) {
-        const headers = {};
+        const headers = { 'X-Priority': 'batch' }; // 一括実行は batch 扱い（混雑時は 429 + Retry-After）
         const body = {
           rid: RID,
           prompt,
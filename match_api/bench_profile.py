@@ -0,0 +1,67 @@
+# bench_profile.py – 候補者プロフィール前処理の「トークン数 / マッチ品質」計測
+#
+#   cd match_api
+#   python bench_profile.py --candidates cands.jsonl --budgets 256,512,800
+#
+#   cands.jsonl は 1 行 1 候補者（{"linkedin_profile": ..., "gold_ids": ["12", ...]}）。
+#   gold_ids（実際に応募・面談に進んだ求人など）があれば embedding 類似度 top-K の recall を、
+#   無ければ従来入力（json.dumps した生プロフィール）の top-K との一致率だけを出す。
+import sys
+import json
+import argparse
+import statistics
+
+import numpy as np
+
+import main
+
+
+def _topk(c_vec, j_vecs, ids, k):
+    scores = j_vecs @ c_vec
+    return [ids[i] for i in np.argsort(-scores)[:k]]
+
+
+def run(cands, budgets, k):
+    jobs = main.load_jobs()
+    ids = [str(j["id"]) for j in jobs]
+    j_vecs = main.job_vectors(jobs)
+    stats = {"raw": []}
+    stats.update({b: [] for b in budgets})
+
+    for cand in cands:
+        c_src = cand.get("linkedin_profile", "")
+        gold = {str(x) for x in cand.get("gold_ids") or []}
+
+        raw_txt = json.dumps(c_src)
+        base = _topk(main.embed(raw_txt), j_vecs, ids, k)
+        recall = len(gold & set(base)) / len(gold) if gold else None
+        stats["raw"].append((main.approx_tokens(raw_txt), 1.0, recall))
+
+        for b in budgets:
+            txt = main.prepare_profile(c_src, b) or raw_txt
+            top = _topk(main.embed(txt), j_vecs, ids, k)
+            recall = len(gold & set(top)) / len(gold) if gold else None
+            stats[b].append((main.approx_tokens(txt), len(set(top) & set(base)) / k, recall))
+
+    print(f"{'variant':>10} {'tokens':>8} {f'agree@{k}':>9} {f'recall@{k}':>10}")
+    for key, rows in stats.items():
+        if not rows:
+            continue
+        toks, agrees, recalls = zip(*rows)
+        recalls = [r for r in recalls if r is not None]
+        rec = f"{statistics.mean(recalls):>10.2f}" if recalls else f"{'-':>10}"
+        print(f"{str(key):>10} {statistics.mean(toks):>8.0f} {statistics.mean(agrees):>9.2f} {rec}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--candidates", required=True, help="候補者 JSONL")
+    ap.add_argument("--budgets", default="256,512,800", help="カンマ区切りのトークン予算")
+    ap.add_argument("--k", type=int, default=20, help="比較する類似度上位件数")
+    args = ap.parse_args()
+
+    with open(args.candidates, encoding="utf-8") as f:
+        cands = [json.loads(line) for line in f if line.strip()]
+    if not cands:
+        sys.exit("no candidates")
+    run(cands, [int(b) for b in args.budgets.split(",") if b], args.k)
@@ -0,0 +1,103 @@
+# bench_prompt.py – scout 選抜プロンプトの「トークン数 / レイテンシ / 選抜品質」計測
+#
+#   cd match_api
+#   python bench_prompt.py --candidates cands.jsonl --budgets 800,1500,2500
+#
+#   cands.jsonl は 1 行 1 候補者（{"linkedin_profile": "..."}）。
+#   基準は従来形式（求人 dict をそのまま JSON で埋め込む）プロンプトの選抜結果で、
+#   各予算の短縮ID表プロンプトが同じ求人を選べた割合を agreement として出す。
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import numpy as np
+
+import main
+
+
+def _legacy_prompt(c_src, jobs):
+    return f"""
+下記候補者 LinkedIn と求人20件から、最もクリック率が高そうな2件だけ JSONで返して。
+キーは id,title,company_desc,salary の4項目のみ。
+### CAND
+{c_src}
+### JOBS
+{json.dumps(jobs, ensure_ascii=False)}
+""".strip()
+
+
+def _count_tokens(prompt, exact):
+    if not exact:
+        return main.approx_tokens(prompt)
+    r = main.CLIENT.models.count_tokens(model=main.MODEL_FLASH, contents=prompt)
+    return int(r.total_tokens)
+
+
+def _timed_gen(prompt):
+    t0 = time.perf_counter()
+    txt = main.strip_fence(main._gen_text_v1(prompt, main.MODEL_FLASH))
+    return txt, time.perf_counter() - t0
+
+
+def _ids(items):
+    out = set()
+    for it in items or []:
+        sid = it.get("id") if isinstance(it, dict) else it
+        if sid:
+            out.add(str(sid))
+    return out
+
+
+def run(cands, budgets, exact):
+    jobs = main.load_jobs()
+    stats = {"legacy": []}
+    stats.update({b: [] for b in budgets})
+
+    for cand in cands:
+        c_src = cand.get("linkedin_profile", "")
+        c_vec = main.embed(json.dumps(c_src))
+        ranked = sorted(jobs, key=lambda j: -float(np.dot(c_vec, main.embed(j["summary"]))))[:20]
+
+        prompt = _legacy_prompt(c_src, ranked)
+        txt, sec = _timed_gen(prompt)
+        try:
+            data = json.loads(txt)
+        except json.JSONDecodeError:
+            data = []
+        if isinstance(data, dict):
+            data = data.get("selected_positions", [])
+        base = _ids(data[:2] if isinstance(data, list) else [])
+        stats["legacy"].append((_count_tokens(prompt, exact), sec, 1.0))
+
+        for b in budgets:
+            prompt, mapping = main.build_scout_prompt(c_src, ranked, b)
+            txt, sec = _timed_gen(prompt)
+            picked = _ids(main.parse_scout_selection(txt, mapping))
+            agree = len(picked & base) / len(base) if base else 0.0
+            stats[b].append((_count_tokens(prompt, exact), sec, agree))
+
+    print(f"{'variant':>10} {'tokens':>8} {'p50 sec':>8} {'agree@2':>8}")
+    for key, rows in stats.items():
+        if not rows:
+            continue
+        toks, secs, agrees = zip(*rows)
+        print(
+            f"{str(key):>10} {statistics.mean(toks):>8.0f} "
+            f"{statistics.median(secs):>8.2f} {statistics.mean(agrees):>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--candidates", required=True, help="候補者 JSONL")
+    ap.add_argument("--budgets", default="800,1500,2500", help="カンマ区切りのトークン予算")
+    ap.add_argument("--exact", action="store_true", help="count_tokens API で正確に数える")
+    args = ap.parse_args()
+
+    with open(args.candidates, encoding="utf-8") as f:
+        cands = [json.loads(line) for line in f if line.strip()]
+    if not cands:
+        sys.exit("no candidates")
+    run(cands, [int(b) for b in args.budgets.split(",") if b], args.exact)
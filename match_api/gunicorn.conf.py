@@ -1,5 +1,9 @@
 # gunicorn.conf.py
+import os
+
 workers   = 1                 # 1 vCPU なので固定 1
+worker_class = "gthread"      # 待ち行列（main.py の admission control）に並べるためスレッドで受ける
+threads   = int(os.getenv("GUNICORN_THREADS", "17"))   # ADMISSION_MAX_INFLIGHT + ADMISSION_QUEUE_MAX
 wsgi_app = "match_api.main:app"   # ← パッケージ名を付ける
 bind      = "0.0.0.0:8080"    # Cloud Run デフォルトポート
 timeout   = 120               # (任意) 60→120 秒に延長
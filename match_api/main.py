@@ -2,11 +2,17 @@
 import os
 import re
 import json
+import math
 import time
-import functools
+import io
+import heapq
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict, deque
 from typing import List, Dict, Any
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, has_app_context, request, jsonify, stream_with_context
 
 # --- Google Sheets (timeout付きhttplib2で安定化) ---
 import google.auth
@@ -20,6 +26,19 @@ from google import genai as genai_v1
 # --- NumPy for similarity ---
 import numpy as np
 
+# --- 共通リトライ / レート制御・求人スナップショット（pdf_ingest と同一モジュール） ---
+try:
+    from match_api.retry_policy import (
+        RETRYABLE_STATUS, RetryableError, call_with_retry, deadline_after, parse_retry_after,
+    )
+    from match_api import job_snapshot, tenant_config
+except ImportError:  # match_api ディレクトリ単体（Procfile: main:app）で起動した場合
+    from retry_policy import (
+        RETRYABLE_STATUS, RetryableError, call_with_retry, deadline_after, parse_retry_after,
+    )
+    import job_snapshot
+    import tenant_config
+
 
 # =========================
 # Env / Clients
@@ -31,6 +50,8 @@ creds, _ = google.auth.default(scopes=SCOPES)
 # Sheets: per-request ではなく Http 生成時に timeout 指定
 _http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=30))
 sheets = build("sheets", "v4", http=_http)
+# httplib2.Http はスレッドセーフではないので、sheets の execute() はこのロック内で呼ぶ
+_SHEETS_LOCK = threading.Lock()
 
 # APIキーは GEMINI_API_KEY 優先、なければ GOOGLE_API_KEY
 _API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY", "")
@@ -39,23 +60,409 @@ CLIENT = genai_v1.Client(api_key=_API_KEY)
 # 生成モデル（既定は 2.5-flash。必要なら ENV で切替）
 MODEL_FLASH = os.getenv("MODEL_FLASH", "gemini-2.5-flash")
 
+# 募集中ステータス（Job_Database D 列）
+OPEN_STATUS = "募集中"
+# proposal で Gemini に渡す事前フィルタ後の上限件数
+PROPOSAL_PREFILTER_MAX = int(os.getenv("PROPOSAL_PREFILTER_MAX", "30"))
+# 求人カタログの最大件数（メモリ節約）
+CATALOG_MAX_ROWS = int(os.getenv("CATALOG_MAX_ROWS", "50"))
+# pdf_ingest が書く Job_Database スナップショット（空なら Sheets API を直接読む）
+JOB_SNAPSHOT_URI = os.getenv("JOB_SNAPSHOT_URI", "")
+SNAPSHOT_CHECK_SEC = int(os.getenv("SNAPSHOT_CHECK_SEC", "30"))
+SNAPSHOT_CACHE_DIR = "/tmp/job_snapshot"
+# スナップショットが無い場合に Sheets から読み直す間隔
+CATALOG_TTL_SEC = int(os.getenv("CATALOG_TTL_SEC", "300"))
+
+# テナント（採用チーム）ごとのシート設定。従来の SPREADSHEET_ID / JOB_SNAPSHOT_URI は "default"
+TENANTS = tenant_config.load_tenants({"sheet_id": SPREADSHEET_ID, "snapshot_uri": JOB_SNAPSHOT_URI})
+DEFAULT_TENANT = tenant_config.DEFAULT_TENANT
+# TENANTS_CONFIG に無くても X-Sheet-Id で受け付けるシート ID（カンマ区切り）
+ALLOWED_SHEET_IDS = {s.strip() for s in os.getenv("ALLOWED_SHEET_IDS", "").split(",") if s.strip()}
+# 全テナント合計のキャッシュ上限（超えたら最近使われていないテナントから捨てる）
+TENANT_CACHE_MB = int(os.getenv("TENANT_CACHE_MB", "512"))
+EMBED_CACHE_MAX = 1_024
+PROFILE_CACHE_MAX = 512
+
 app = Flask(__name__)
 
 
+# =========================
+# Admission control (bounded queue / priority)
+# =========================
+# gunicorn の gthread で受けたリクエストのうち、同時に処理するのは ADMISSION_MAX_INFLIGHT 件まで。
+# 残りは優先度順（interactive → batch）の待ち行列に並べ、溢れたら 429 + Retry-After で即返す。
+# 2 以上にすると同じテナントに複数スレッドが入る（テナント状態・Sheets クライアントはロックで保護）
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "1"))
+ADMISSION_QUEUE_MAX = int(os.getenv("ADMISSION_QUEUE_MAX", "16"))          # 待ち行列の上限（全クラス）
+ADMISSION_BATCH_QUEUE_MAX = int(os.getenv("ADMISSION_BATCH_QUEUE_MAX", "4"))  # batch が並べる上限
+ADMISSION_MAX_WAIT_SEC = float(os.getenv("ADMISSION_MAX_WAIT_SEC", "30"))   # これ以上待たせるなら 429
+_PRIORITIES = {"interactive": 0, "batch": 1}
+# /precompute は /match の枠を使わず専用の 1 枠で走らせる（処理時間 EWMA にも入れない）
+_ADMIT_EXEMPT = ("/healthz", "/metrics", "/precompute")
+
+_ADMIT: Dict[str, Any] = {
+    "cond": threading.Condition(),
+    "inflight": 0,
+    "heap": [],                 # (priority, seq) の待ち行列
+    "seq": 0,
+    "service_sec": 2.0,         # 1 件あたり処理時間の EWMA（初期値は控えめな見積もり）
+    "admitted": {k: 0 for k in _PRIORITIES},
+    "rejected": {k: 0 for k in _PRIORITIES},
+    "waits": {k: deque(maxlen=512) for k in _PRIORITIES},
+}
+
+
+def _priority_class() -> str:
+    """X-Priority: interactive|batch（?priority= でも可）"""
+    v = (request.headers.get("X-Priority") or request.args.get("priority") or "").strip().lower()
+    return v if v in _PRIORITIES else "interactive"
+
+
+def _eta_sec(ahead: int) -> float:
+    """前に ahead 件いるときの待ち時間見積もり（処理時間 EWMA ÷ 同時処理数）"""
+    return (ahead + 1) * _ADMIT["service_sec"] / max(1, ADMISSION_MAX_INFLIGHT)
+
+
+def _retry_after(ahead: int) -> int:
+    return max(1, min(120, math.ceil(_eta_sec(ahead))))
+
+
+def _admit(cls: str) -> int:
+    """
+    処理枠を取れるまで待つ。取れたら 0、断るときは Retry-After 秒を返す。
+    キューが満杯・batch 枠が満杯・見積もり待ち時間が ADMISSION_MAX_WAIT_SEC 超なら並ばずに断り、
+    並んだ後でも ADMISSION_MAX_WAIT_SEC を過ぎたら列を抜けて断る。
+    """
+    st = _ADMIT
+    prio = _PRIORITIES[cls]
+    with st["cond"]:
+        waiting = len(st["heap"])
+        ahead = st["inflight"] + sum(1 for p, _ in st["heap"] if p <= prio)
+        batch_waiting = sum(1 for p, _ in st["heap"] if p == _PRIORITIES["batch"])
+        full = waiting >= ADMISSION_QUEUE_MAX or (cls == "batch" and batch_waiting >= ADMISSION_BATCH_QUEUE_MAX)
+        if st["inflight"] >= ADMISSION_MAX_INFLIGHT and (full or _eta_sec(ahead) > ADMISSION_MAX_WAIT_SEC):
+            st["rejected"][cls] += 1
+            return _retry_after(ahead)
+
+        st["seq"] += 1
+        me = (prio, st["seq"])
+        heapq.heappush(st["heap"], me)
+        t0 = time.monotonic()
+        deadline = t0 + ADMISSION_MAX_WAIT_SEC
+        while st["heap"][0] != me or st["inflight"] >= ADMISSION_MAX_INFLIGHT:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                st["heap"].remove(me)
+                heapq.heapify(st["heap"])
+                st["cond"].notify_all()
+                st["rejected"][cls] += 1
+                return _retry_after(len(st["heap"]))
+            st["cond"].wait(left)
+        heapq.heappop(st["heap"])
+        st["inflight"] += 1
+        st["admitted"][cls] += 1
+        st["waits"][cls].append(time.monotonic() - t0)
+        st["cond"].notify_all()   # 同時処理数に空きがあれば次の先頭も進める
+    return 0
+
+
+def _release(started: float) -> None:
+    st = _ADMIT
+    with st["cond"]:
+        st["inflight"] -= 1
+        st["service_sec"] = 0.8 * st["service_sec"] + 0.2 * (time.monotonic() - started)
+        st["cond"].notify_all()
+
+
+def admission_metrics() -> Dict[str, Any]:
+    """キュー深さ・待ち時間（直近 512 件の p50/p95）・処理レートのスナップショット"""
+    st = _ADMIT
+    with st["cond"]:
+        depth = {cls: sum(1 for p, _ in st["heap"] if p == prio) for cls, prio in _PRIORITIES.items()}
+        waits = {cls: sorted(w) for cls, w in st["waits"].items()}
+        out = {
+            "inflight": st["inflight"],
+            "max_inflight": ADMISSION_MAX_INFLIGHT,
+            "queue_depth": depth,
+            "queue_max": ADMISSION_QUEUE_MAX,
+            "service_sec_ewma": round(st["service_sec"], 3),
+            "drain_per_sec": round(ADMISSION_MAX_INFLIGHT / max(st["service_sec"], 1e-3), 3),
+            "admitted": dict(st["admitted"]),
+            "rejected": dict(st["rejected"]),
+        }
+    out["wait_sec"] = {
+        cls: {
+            "p50": round(w[len(w) // 2], 3) if w else 0.0,
+            "p95": round(w[min(len(w) - 1, int(len(w) * 0.95))], 3) if w else 0.0,
+        }
+        for cls, w in waits.items()
+    }
+    return out
+
+
+@app.before_request
+def _admission():
+    if request.path in _ADMIT_EXEMPT:
+        return None
+    # 未知の X-Tenant / 許可されていない X-Sheet-Id は枠を取る前に 403（待たせず、処理時間の EWMA にも入れない）
+    try:
+        resolve_tenant(request.headers)
+    except PermissionError as e:
+        return jsonify(error=str(e)), 403
+    cls = _priority_class()
+    retry_after = _admit(cls)
+    if retry_after:
+        print(f"[ADMIT] reject {cls} {request.path} retry_after={retry_after}s")
+        resp = jsonify(error="server busy", priority=cls, retry_after=retry_after)
+        return resp, 429, {"Retry-After": str(retry_after)}
+    g.admitted_at = time.monotonic()
+    return None
+
+
+@app.teardown_request
+def _admission_release(exc=None):
+    # stream_with_context のレスポンスはストリーム終了後にここへ来る
+    started = g.pop("admitted_at", None)
+    if started is not None:
+        _release(started)
+
+
+@app.route("/metrics")
+def metrics():
+    return jsonify(admission_metrics()), 200
+
+
+# =========================
+# Tenants (per-sheet state / LRU eviction)
+# =========================
+_TENANT_STATES: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()   # 古い順（末尾が直近）
+_TENANT_LOCK = threading.Lock()
+
+
+def _new_tenant_state(name: str, conf: Dict[str, str]) -> Dict[str, Any]:
+    """テナント 1 つ分のカタログ・embedding・事前計算・プロフィール前処理キャッシュ"""
+    return {
+        "name": name,
+        "conf": conf,
+        # 同じテナントに複数スレッドが入った時のためのロック（カタログ更新・行列 patch・LRU 操作）
+        "lock": threading.RLock(),
+        "snap": {"checked_at": 0.0, "data": None},
+        # カタログの版管理（id ごとの内容ハッシュ）と求人ベクトル行列
+        "catalog": {
+            "version": 0, "source": None, "loaded_at": 0.0, "bytes": 0,
+            "jobs": [], "hashes": {}, "keys": [], "row_of": {}, "vecs": None, "dirty": set(),
+        },
+        "index": {"src": None, "index": None},
+        "precomp": {"checked_at": 0.0, "data": None},
+        "embeds": OrderedDict(),
+        "profiles": OrderedDict(),
+        "cache_bytes": 0,
+    }
+
+
+def _tenant_conf(name: str) -> Dict[str, str]:
+    if name in TENANTS:
+        return TENANTS[name]
+    if name.startswith("sheet:") and name[6:] in ALLOWED_SHEET_IDS:
+        return {**{f: "" for f in tenant_config.FIELDS}, "sheet_id": name[6:]}
+    raise PermissionError(f"unknown tenant: {name}")
+
+
+def tenant_state(name: str = DEFAULT_TENANT) -> Dict[str, Any]:
+    """テナントの状態（無ければ作る）を返し、LRU の末尾に回す"""
+    with _TENANT_LOCK:
+        st = _TENANT_STATES.get(name)
+        if st is None:
+            st = _TENANT_STATES[name] = _new_tenant_state(name, _tenant_conf(name))
+        _TENANT_STATES.move_to_end(name)
+        return st
+
+
+def _tenant() -> Dict[str, Any]:
+    """リクエストに紐付いたテナント（リクエスト外 = 起動時・CLI は default）"""
+    if has_app_context() and "tenant" in g:
+        return g.tenant
+    return tenant_state(DEFAULT_TENANT)
+
+
+def resolve_tenant(headers) -> str:
+    """
+    X-Tenant（TENANTS_CONFIG の名前）か X-Sheet-Id からテナント名を決める。
+    どちらも無ければ default。許可されていないものは PermissionError。
+    """
+    name = (headers.get("X-Tenant") or "").strip()
+    sheet_id = (headers.get("X-Sheet-Id") or "").strip()
+    if name:
+        if name not in TENANTS:
+            raise PermissionError(f"unknown tenant: {name}")
+        if sheet_id and sheet_id != TENANTS[name]["sheet_id"]:
+            raise PermissionError("X-Sheet-Id does not match X-Tenant")
+        return name
+    if sheet_id:
+        for n, conf in TENANTS.items():
+            if conf["sheet_id"] == sheet_id:
+                return n
+        if sheet_id in ALLOWED_SHEET_IDS:
+            return f"sheet:{sheet_id}"
+        raise PermissionError("sheet id not allowed")
+    return DEFAULT_TENANT
+
+
+def _tenant_dir(st: Dict[str, Any]) -> str:
+    """テナント名をファイル名に使える形にする"""
+    return re.sub(r"[^\w.-]", "_", st["name"])
+
+
+def _cache_get(st: Dict[str, Any], kind: str, key: Any) -> Any:
+    with st["lock"]:
+        hit = st[kind].get(key)
+        if hit is None:
+            return None
+        st[kind].move_to_end(key)
+        return hit[0]
+
+
+def _cache_put(st: Dict[str, Any], kind: str, key: Any, value: Any, size: int, limit: int) -> None:
+    """テナント内 LRU（embeds / profiles）に入れ、バイト数を数える"""
+    with st["lock"]:
+        cache = st[kind]
+        if key in cache:
+            return
+        cache[key] = (value, size)
+        st["cache_bytes"] += size
+        while len(cache) > limit:
+            _, (_, old) = cache.popitem(last=False)
+            st["cache_bytes"] -= old
+
+
+def _tenant_bytes(st: Dict[str, Any]) -> int:
+    """テナントが抱えているメモリの概算（mmap のスナップショット行列は数えない）"""
+    cat = st["catalog"]
+    total = cat["bytes"] + st["cache_bytes"]
+    if cat["vecs"] is not None and not isinstance(cat["vecs"], np.memmap):
+        total += cat["vecs"].nbytes
+    pre = st["precomp"]["data"]
+    if pre:
+        total += sum(v.nbytes for v in pre.values() if isinstance(v, np.ndarray)) + 100 * len(pre["row"])
+    return total
+
+
+def enforce_cache_budget() -> None:
+    """
+    全テナント合計が TENANT_CACHE_MB を超えていたら、最近使われていないテナントから
+    状態ごと捨てる（次のリクエストで読み直す）。処理中のテナントは捨てずに、
+    それでも超える場合だけ embedding / プロフィールのキャッシュを古い順に削る。
+    """
+    budget = TENANT_CACHE_MB * 1024 * 1024
+    current = _tenant()["name"]
+    with _TENANT_LOCK:
+        sizes = {name: _tenant_bytes(st) for name, st in _TENANT_STATES.items()}
+        total = sum(sizes.values())
+        for name in list(_TENANT_STATES):
+            if total <= budget:
+                break
+            if name == current:
+                continue
+            st = _TENANT_STATES.pop(name)
+            total -= sizes[name]
+            _drop_snapshot_cache(st)
+            print(f"[TENANT] evict {name} freed={sizes[name] // 1024}KiB total={total // 1024}KiB")
+        st = _TENANT_STATES.get(current)
+    if st is None or total <= budget:
+        return
+    with st["lock"]:   # _TENANT_LOCK を離してから取る（ロック順を tenant → 全体 に揃える）
+        while total > budget and (st["embeds"] or st["profiles"]):
+            cache = st["embeds"] or st["profiles"]
+            _, (_, size) = cache.popitem(last=False)
+            st["cache_bytes"] -= size
+            total -= size
+
+
+@app.before_request
+def _bind_tenant():
+    if request.path in ("/healthz", "/metrics"):
+        return None
+    try:
+        g.tenant = tenant_state(resolve_tenant(request.headers))
+    except PermissionError as e:
+        return jsonify(error=str(e)), 403
+    return None
+
+
+@app.after_request
+def _after_tenant(resp):
+    if "tenant" in g:
+        enforce_cache_budget()
+    return resp
+
+
 # =========================
 # Utilities
 # =========================
-@functools.lru_cache
-def load_jobs() -> List[Dict[str, Any]]:
-    """Job_Database!A:K から最大 50 件だけ取得（メモリ節約）"""
-    vals = (
-        sheets.spreadsheets()
-        .values()
-        .get(spreadsheetId=SPREADSHEET_ID, range="Job_Database!A:K")
-        .execute()
-        .get("values", [])
-    )
-    vals = vals[1:51]  # ヘッダー除外 & 上限
+# 求人 dict に載せる列（スナップショットの J/K 列はプロンプトに使わない）
+_CATALOG_KEYS = (
+    "id", "company", "title", "status", "summary", "loc", "salary",
+    "required_skills", "preferred_skills",
+)
+def _job_snapshot() -> Dict[str, Any]:
+    """
+    LATEST の版が変わっていればスナップショットを読み直す（SNAPSHOT_CHECK_SEC 間隔）。
+    読めなければ直前の版を使い続け、一度も読めていなければ None（Sheets へフォールバック）。
+    """
+    st = _tenant()
+    uri, state = st["conf"]["snapshot_uri"], st["snap"]
+    if not uri:
+        return None
+    now = time.time()
+    if now - state["checked_at"] < SNAPSHOT_CHECK_SEC:
+        return state["data"]
+    state["checked_at"] = now
+    try:
+        latest = job_snapshot.read_latest(uri)
+        cur = state["data"]
+        if latest and (cur is None or latest["version"] != cur["version"]):
+            cache_dir = os.path.join(SNAPSHOT_CACHE_DIR, _tenant_dir(st))
+            snap = job_snapshot.load_snapshot(uri, latest["version"], cache_dir)
+            rows = range(min(len(snap["records"]), CATALOG_MAX_ROWS))
+            state["data"] = {
+                "version": snap["version"],
+                "jobs": [{k: snap["records"][i][k] for k in _CATALOG_KEYS} for i in rows],
+                "embeddings": snap["embeddings"],
+            }
+            print(f"[SNAPSHOT] {st['name']} loaded v{snap['version']} jobs={len(rows)}")
+            _prune_snapshot_cache(uri, cache_dir, snap["version"])
+    except Exception as e:
+        print(f"[SNAPSHOT] {st['name']} load failed: {e}")
+    return state["data"]
+
+
+def _prune_snapshot_cache(uri: str, cache_dir: str, keep_version: int) -> None:
+    """/tmp（= メモリ）に落とした古い版を消す"""
+    if not uri.startswith("gs://") or not os.path.isdir(cache_dir):
+        return
+    import shutil
+    for name in os.listdir(cache_dir):
+        if name != f"v{keep_version:08d}":
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def _drop_snapshot_cache(st: Dict[str, Any]) -> None:
+    """追い出したテナントの /tmp キャッシュを消す"""
+    import shutil
+    shutil.rmtree(os.path.join(SNAPSHOT_CACHE_DIR, _tenant_dir(st)), ignore_errors=True)
+
+
+def _load_catalog_sheets() -> List[Dict[str, Any]]:
+    """Job_Database!A:K から最大 CATALOG_MAX_ROWS 件だけ取得（ステータス問わず）"""
+    with _SHEETS_LOCK:
+        vals = (
+            sheets.spreadsheets()
+            .values()
+            .get(spreadsheetId=_tenant()["conf"]["sheet_id"], range="Job_Database!A:K")
+            .execute()
+            .get("values", [])
+        )
+    vals = vals[1:CATALOG_MAX_ROWS + 1]  # ヘッダー除外 & 上限
     return [
         dict(
             id=r[0],
@@ -65,21 +472,168 @@ def load_jobs() -> List[Dict[str, Any]]:
             summary=r[4] if len(r) > 4 else "",
             loc=r[5] if len(r) > 5 else "",
             salary=r[6] if len(r) > 6 else "",
+            required_skills=r[7] if len(r) > 7 else "",
+            preferred_skills=r[8] if len(r) > 8 else "",
         )
         for r in vals
-        if len(r) > 6 and r[3] == "募集中"
+        if len(r) > 6
     ]
 
 
-@functools.lru_cache(maxsize=1_024)
-def _embed_cached(text: str) -> tuple:
-    """Embedding API（結果は tuple 化してキャッシュ）"""
-    vec = _embed_once(text)
-    return tuple(vec)
+def _job_hashes(job: Dict[str, Any]) -> tuple:
+    """(レコード全体のハッシュ, summary のハッシュ)"""
+    whole = json.dumps(job, sort_keys=True, ensure_ascii=False)
+    return _sha1(whole), _sha1(job.get("summary", ""))
+
+
+def _row_slots(jobs: List[Dict[str, Any]]) -> List[tuple]:
+    """差分用の行キー (id, 同じ id の何件目か)。空 id や重複 id の行も別の行として数える"""
+    seen: Dict[str, int] = {}
+    slots = []
+    for j in jobs:
+        n = seen.get(j["id"], 0)
+        seen[j["id"]] = n + 1
+        slots.append((j["id"], n))
+    return slots
+
+
+def _vec_key(job: Dict[str, Any]) -> tuple:
+    """ベクトル行のキー (id, summary のハッシュ)。重複 id でも summary が違えば別ベクトル"""
+    return job["id"], _sha1(job.get("summary", ""))
+
+
+def _refresh_catalog(jobs: List[Dict[str, Any]], source: tuple, snap: Dict[str, Any] = None) -> None:
+    """
+    前の版と (id, 何件目) × 内容ハッシュで差分を取り、ベクトル行列を引き継ぐ。
+    ベクトルは (id, summary ハッシュ) で引くので、重複 id の行どうしが混ざらない。
+    - id の並びが同じなら行列をそのまま使い、キーが変わった行だけ dirty にする（in-place 更新）
+    - 追加・削除で並びが変わったら、残った行だけ新しい行列へコピー
+    - スナップショット由来なら embedding 済みの mmap をそのまま使う
+    dirty 行は job_vectors() が最初に必要になった時にまとめて embedding する。
+    """
+    cat = _tenant()["catalog"]
+    old_hashes, old_keys, old_row, old_vecs = cat["hashes"], cat["keys"], cat["row_of"], cat["vecs"]
+    hashes = {slot: _job_hashes(j) for slot, j in zip(_row_slots(jobs), jobs)}
+    added = [i for i in hashes if i not in old_hashes]
+    removed = [i for i in old_hashes if i not in hashes]
+    changed = [i for i in hashes if i in old_hashes and hashes[i][0] != old_hashes[i][0]]
+
+    keys = [_vec_key(j) for j in jobs]
+    row_of = {k: r for r, k in enumerate(keys)}
+    # 新規 / summary 変更 / 前の版で embedding 待ちのまま残っていた行
+    dirty = {k for k in keys if k not in old_row or k in cat["dirty"]}
+
+    if snap is not None and snap["embeddings"].shape[1]:
+        vecs, dirty = snap["embeddings"][:len(keys)], set()
+    elif old_vecs is None:
+        vecs, dirty = None, set(keys)
+    elif [k[0] for k in keys] == [k[0] for k in old_keys] and old_vecs.flags.writeable:
+        vecs = old_vecs                                   # 並び同じ → in-place で patch
+        dirty |= {k for k, old in zip(keys, old_keys) if k != old}
+    else:
+        vecs = np.zeros((len(keys), old_vecs.shape[1]), dtype=np.float32)
+        keep = [(r, old_row[k]) for r, k in enumerate(keys) if k in old_row and k not in dirty]
+        if keep:
+            new_rows, old_rows = map(list, zip(*keep))
+            vecs[new_rows] = old_vecs[old_rows]
+
+    cat.update(
+        version=cat["version"] + 1, source=source, loaded_at=time.time(),
+        jobs=jobs, hashes=hashes, keys=keys, row_of=row_of, vecs=vecs, dirty=dirty,
+        bytes=sum(len(json.dumps(j, ensure_ascii=False).encode("utf-8")) for j in jobs),
+    )
+    print(
+        f"[CATALOG] {_tenant()['name']} v{cat['version']} source={source[0]} jobs={len(jobs)} "
+        f"added={len(added)} changed={len(changed)} removed={len(removed)} reembed={len(dirty)}"
+    )
+
+
+def load_catalog() -> List[Dict[str, Any]]:
+    """
+    スナップショットがあればそれを、無ければ Sheets API（CATALOG_TTL_SEC ごと）から
+    求人カタログを返す。読み直しに失敗したら直前の版を使い続ける。
+    """
+    st = _tenant()
+    cat = st["catalog"]
+    with st["lock"]:
+        snap = _job_snapshot()
+        if snap is not None:
+            if cat["source"] != ("snapshot", snap["version"]):
+                _refresh_catalog(snap["jobs"], ("snapshot", snap["version"]), snap)
+            return cat["jobs"]
+
+        stale = time.time() - cat["loaded_at"] > CATALOG_TTL_SEC
+        if cat["source"] is None or cat["source"][0] != "sheets" or stale:
+            try:
+                _refresh_catalog(_load_catalog_sheets(), ("sheets", None))
+            except Exception as e:
+                if cat["source"] is None:
+                    raise
+                print(f"[CATALOG] sheets reload failed, keep v{cat['version']}: {e}")
+                cat["loaded_at"] = time.time()
+        return cat["jobs"]
+
+
+# 起動時にスナップショットを mmap で開いておく（無ければ初回リクエストで Sheets を読む）
+_job_snapshot()
+
+
+def load_jobs() -> List[Dict[str, Any]]:
+    """募集中の求人だけ返す（scout / proposal の母集団）"""
+    return [j for j in load_catalog() if j["status"] == OPEN_STATUS]
 
 
 def embed(text: str) -> np.ndarray:
-    return np.array(_embed_cached(text))
+    """Embedding API（テナントごとの LRU にキャッシュ）"""
+    st = _tenant()
+    vec = _cache_get(st, "embeds", text)
+    if vec is None:
+        vec = np.array(_embed_once(text))
+        _cache_put(st, "embeds", text, vec, vec.nbytes + len(text.encode("utf-8")), EMBED_CACHE_MAX)
+    return vec
+
+
+def _ensure_job_vecs() -> None:
+    """dirty 行（追加・summary 変更）だけ batch embedding してベクトル行列を patch する"""
+    cat = _tenant()["catalog"]
+    dirty = [r for r, k in enumerate(cat["keys"]) if k in cat["dirty"]]
+    if not dirty:
+        return
+    jobs = cat["jobs"]
+    texts = [jobs[r]["summary"] for r in dirty]
+    nonempty = [k for k, t in enumerate(texts) if t.strip()]
+    fresh = _embed_batch([texts[k] for k in nonempty]) if nonempty else np.zeros((0, 0), dtype=np.float32)
+
+    vecs = cat["vecs"]
+    if vecs is None or (not vecs.shape[1] and fresh.size):
+        dim = fresh.shape[1] if fresh.size else 0
+        vecs = np.zeros((len(jobs), dim), dtype=np.float32)
+    rows = np.array(dirty)
+    vecs[rows] = 0.0
+    if nonempty and vecs.shape[1]:
+        vecs[rows[nonempty]] = fresh
+    cat.update(vecs=vecs, dirty=set())
+    print(f"[CATALOG] v{cat['version']} embedded={len(nonempty)} rows")
+
+
+def job_vectors(jobs: List[Dict[str, Any]]) -> np.ndarray:
+    """求人 summary の embedding 行列（カタログ行列から行を引く。無い求人だけ個別に embedding）"""
+    st = _tenant()
+    with st["lock"]:   # patch 中の行列を読まないよう、更新と行のコピーを同じロック内で行う
+        load_catalog()
+        _ensure_job_vecs()
+        vecs, row_of = st["catalog"]["vecs"], st["catalog"]["row_of"]
+        out = []
+        for j in jobs:
+            row = row_of.get(_vec_key(j))
+            if row is not None and vecs is not None and vecs.shape[1]:
+                out.append(np.array(vecs[row]))
+            elif j["summary"].strip():
+                out.append(embed(j["summary"]))
+            else:
+                out.append(None)   # summary 空は embedding API に送らずゼロベクトル
+    dim = next((len(v) for v in out if v is not None), 0)
+    return np.vstack([np.zeros(dim, dtype=np.float32) if v is None else v for v in out]) if out else np.zeros((0, 0))
 
 
 def strip_fence(txt: str) -> str:
@@ -100,6 +654,478 @@ def strip_fence(txt: str) -> str:
     return s.strip()
 
 
+# =========================
+# Catalog filter engine (salary / location / status / skills)
+# =========================
+_MAN_YEN = 10_000
+_SALARY_NUM_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(億|万|円)?")
+_MUST_SALARY_RE = re.compile(r"(?:年収|salary)\s*[:：]?\s*(\d+)", re.I)
+_TOKEN_SPLIT_RE = re.compile(r"[\s,、，/／・|｜()（）\[\]【】:：;；]+")
+
+
+def _canon(txt: str) -> str:
+    """全角→半角・空白削除・lowercase（pdf_ingest.canon と同じ正規化）"""
+    if not txt:
+        return ""
+    txt = unicodedata.normalize("NFKC", str(txt))
+    txt = re.sub(r"\s+", "", txt)
+    return txt.lower()
+
+
+def _parse_salary_range(s: str) -> tuple:
+    """給与表記から (下限, 上限) を万円単位で返す。読めなければ (nan, nan)"""
+    if not s:
+        return (np.nan, np.nan)
+    t = unicodedata.normalize("NFKC", str(s)).replace(",", "")
+    vals = []
+    for num, unit in _SALARY_NUM_RE.findall(t):
+        v = float(num)
+        if unit == "億":
+            v *= 10_000
+        elif v >= 100_000:   # 円表記（8000000円 など）
+            v /= _MAN_YEN
+        if 100 <= v <= 10_000:   # 年収として妥当なレンジ（万円）だけ採用
+            vals.append(v)
+    if not vals:
+        return (np.nan, np.nan)
+    return (min(vals), max(vals))
+
+
+def _skill_terms(txt: str) -> List[str]:
+    """スキル欄（改行区切り）を 1 行 = 1 語 + 区切り記号で割った語 に展開"""
+    terms = []
+    for line in (txt or "").splitlines():
+        whole = _canon(line.lstrip("・-*• "))
+        if not whole:
+            continue
+        terms.append(whole)
+        terms.extend(t for t in (_canon(x) for x in _TOKEN_SPLIT_RE.split(line)) if t and t != whole)
+    return terms
+
+
+def _build_job_index(jobs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """求人リストから NumPy 列と required/preferred スキルの転置インデックスを作る"""
+    lo, hi = zip(*(_parse_salary_range(j.get("salary", "")) for j in jobs)) if jobs else ((), ())
+    postings: Dict[str, set] = {}
+    for i, j in enumerate(jobs):
+        for term in _skill_terms(j.get("required_skills", "")) + _skill_terms(j.get("preferred_skills", "")):
+            postings.setdefault(term, set()).add(i)
+    return {
+        "jobs": jobs,
+        "salary_lo": np.array(lo, dtype=float),
+        "salary_hi": np.array(hi, dtype=float),
+        "status": np.array([j.get("status", "") for j in jobs], dtype=str),
+        "loc": np.array([_canon(j.get("loc", "")) for j in jobs], dtype=str),
+        "postings": postings,
+    }
+
+
+def _catalog_index() -> Dict[str, Any]:
+    """カタログ（list オブジェクト）が差し替わった時だけ作り直す"""
+    st = _tenant()
+    with st["lock"]:
+        catalog = load_catalog()
+        cache = st["index"]
+        if cache["src"] is not catalog:
+            cache["src"], cache["index"] = catalog, _build_job_index(catalog)
+        return cache["index"]
+
+
+def _skill_mask(index: Dict[str, Any], term: str) -> np.ndarray:
+    """
+    語に一致するスキル語彙の posting を OR した bool マスク。
+    完全一致が無い時、日本語などは部分一致、英数字の語は単語境界で一致（go が google / django に当たらない）。
+    """
+    mask = np.zeros(len(index["jobs"]), dtype=bool)
+    q = _canon(term)
+    if not q:
+        return mask
+    rows = index["postings"].get(q)
+    if rows is None:
+        if q.isascii():
+            # 直後の数字は版番号（python3 / java8）として許す。c が c++ / c# に当たらないよう + # は境界にしない
+            word = re.compile(rf"(?<![a-z0-9]){re.escape(q)}(?![a-z+#])")
+            keys = [key for key in index["postings"] if word.search(key)]
+        else:
+            keys = [key for key in index["postings"] if q in key]
+        rows = set().union(*(index["postings"][key] for key in keys))
+    if rows:
+        mask[list(rows)] = True
+    return mask
+
+
+def parse_must(must: Any) -> Dict[str, Any]:
+    """
+    must 条件を正規化する。
+    - 数値 / 数字文字列 → 最低年収（万円）
+    - dict → min_salary / max_salary / location / status / skills / keywords
+    - 自由記述 → 「年収 800」のような記載だけ拾い、残りは LLM 側の判断に任せる
+    """
+    cond: Dict[str, Any] = {}
+    if isinstance(must, dict):
+        for key in ("min_salary", "max_salary"):
+            try:
+                if must.get(key) not in (None, ""):
+                    cond[key] = float(must[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"must.{key} must be a number")
+        for key in ("location", "status"):
+            if must.get(key):
+                cond[key] = str(must[key])
+        for key in ("skills", "keywords"):
+            val = must.get(key)
+            if isinstance(val, str):
+                val = [v for v in _TOKEN_SPLIT_RE.split(val) if v]
+            if val:
+                cond[key] = [str(v) for v in val]
+        return cond
+
+    s = unicodedata.normalize("NFKC", str(must or "")).strip()
+    if s.isdigit():
+        cond["min_salary"] = float(s)
+    else:
+        m = _MUST_SALARY_RE.search(s)
+        if m:
+            cond["min_salary"] = float(m.group(1))
+    return cond
+
+
+def filter_jobs(cond: Dict[str, Any], index: Dict[str, Any] = None, limit: int = None) -> List[Dict[str, Any]]:
+    """
+    parse_must() の条件を NumPy マスクで評価して求人を返す。
+    - 年収: 求人の上限 >= min_salary, 下限 <= max_salary（読めない給与は除外）
+    - 勤務地: 部分一致 / status: 完全一致（既定は募集中）
+    - skills: すべて含む（AND） / keywords: いずれか含む（OR）
+    並び順はスキル・キーワードのヒット数降順、同数なら元の順。
+    """
+    if index is None:
+        index = _catalog_index()
+    n = len(index["jobs"])
+    mask = index["status"] == cond.get("status", OPEN_STATUS)
+
+    with np.errstate(invalid="ignore"):
+        if "min_salary" in cond:
+            mask &= index["salary_hi"] >= cond["min_salary"]
+        if "max_salary" in cond:
+            mask &= index["salary_lo"] <= cond["max_salary"]
+    if cond.get("location"):
+        mask &= np.char.find(index["loc"], _canon(cond["location"])) >= 0
+
+    hits = np.zeros(n, dtype=int)
+    for term in cond.get("skills", []):
+        m = _skill_mask(index, term)
+        mask &= m
+        hits += m
+    if cond.get("keywords"):
+        any_kw = np.zeros(n, dtype=bool)
+        for term in cond["keywords"]:
+            m = _skill_mask(index, term)
+            any_kw |= m
+            hits += m
+        mask &= any_kw
+
+    idx = np.flatnonzero(mask)
+    idx = idx[np.argsort(-hits[idx], kind="stable")]
+    if limit is not None:
+        idx = idx[:limit]
+    return [index["jobs"][i] for i in idx]
+
+
+# =========================
+# Prompt compaction (token budget)
+# =========================
+# 求人表の列（先頭は短縮 ID）
+_TABLE_COLS = ("id", "company", "title", "loc", "salary", "skills", "summary")
+# 類似度順位ごとの詳細度: (対象件数, summary 文字数, skills 行数)。最後は残り全件
+_PROMPT_TIERS = ((5, 300, 5), (10, 100, 2), (None, 0, 0))
+SCOUT_JOB_TOKEN_BUDGET = int(os.getenv("SCOUT_JOB_TOKEN_BUDGET", "2500"))
+PROPOSAL_JOB_TOKEN_BUDGET = int(os.getenv("PROPOSAL_JOB_TOKEN_BUDGET", "4000"))
+
+
+def approx_tokens(text: str) -> int:
+    """トークン数の概算（ASCII は 4 文字 ≒ 1 token、日本語などは 1 文字 ≒ 1 token）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _cell(value: Any, limit: int = None) -> str:
+    """表の 1 セル分に整形（改行・区切り文字を潰し、必要なら末尾を … で丸める）"""
+    s = re.sub(r"\s+", " ", str(value or "")).replace("|", "／").strip()
+    if limit is not None and len(s) > limit:
+        s = s[:max(0, limit - 1)] + "…" if limit else ""
+    return s
+
+
+def _job_row(short_id: str, job: Dict[str, Any], summary_chars: int, skill_lines: int) -> str:
+    skills = [l.strip() for l in (job.get("required_skills") or "").splitlines() if l.strip()]
+    return "|".join([
+        short_id,
+        _cell(job.get("company"), 40),
+        _cell(job.get("title"), 60),
+        _cell(job.get("loc"), 20),
+        _cell(job.get("salary"), 30),
+        _cell(" / ".join(skills[:skill_lines])),
+        _cell(job.get("summary"), summary_chars),
+    ])
+
+
+def _tier_for_rank(rank: int) -> int:
+    bound = 0
+    for i, (count, _, _) in enumerate(_PROMPT_TIERS):
+        if count is None:
+            return i
+        bound += count
+        if rank < bound:
+            return i
+    return len(_PROMPT_TIERS) - 1
+
+
+def build_job_table(ranked_jobs: List[Dict[str, Any]], budget_tokens: int) -> tuple:
+    """
+    類似度順に並んだ求人を、トークン予算内の「短縮ID付き表」に直列化する。
+    上位ほど summary / skills を厚く、下位は列を落とす。入らない行は詳細度を
+    下げて再挑戦し、それでも入らなければそこで打ち切る。
+    返り値: (表テキスト, {短縮ID: 元レコード})
+    """
+    header = "|".join(_TABLE_COLS)
+    used = approx_tokens(header) + 1
+    lines = [header]
+    mapping: Dict[str, Dict[str, Any]] = {}
+
+    for rank, job in enumerate(ranked_jobs):
+        short_id = f"J{rank + 1}"
+        row = None
+        for _, summary_chars, skill_lines in _PROMPT_TIERS[_tier_for_rank(rank):]:
+            cand_row = _job_row(short_id, job, summary_chars, skill_lines)
+            if used + approx_tokens(cand_row) + 1 <= budget_tokens:
+                row = cand_row
+                break
+        if row is None:
+            break
+        lines.append(row)
+        used += approx_tokens(row) + 1
+        mapping[short_id] = job
+    return "\n".join(lines), mapping
+
+
+def restore_jobs(items: Any, mapping: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    モデルが返した短縮ID（文字列 or {"id": ...} の dict）を元レコードに戻す。
+    dict の場合は id 以外のキー（company_desc / score など）を足す。元レコードの
+    値はモデル出力で上書きしない。表にない ID は捨てる。
+    """
+    if not isinstance(items, list):
+        return []
+    out = []
+    for it in items:
+        sid = it.get("id") if isinstance(it, dict) else it
+        job = mapping.get(str(sid or "").strip())
+        if job is None:
+            continue
+        extra = {k: v for k, v in it.items() if k != "id"} if isinstance(it, dict) else {}
+        out.append({**extra, **job})
+    return out
+
+
+# =========================
+# Candidate profile preprocessing (normalize / dedup / chunk / rank)
+# =========================
+# 候補者テキストの予算（embedding 入力 / プロンプトの ### CAND 欄）
+CAND_EMBED_TOKEN_BUDGET = int(os.getenv("CAND_EMBED_TOKEN_BUDGET", "512"))
+CAND_PROMPT_TOKEN_BUDGET = int(os.getenv("CAND_PROMPT_TOKEN_BUDGET", "800"))
+_CHUNK_TOKENS = 160
+
+# LinkedIn のスクレイプ・PDF 履歴書に混ざる UI 文言やページ番号など（1 行まるごと一致で捨てる）
+_BOILERPLATE_RES = tuple(re.compile(p, re.I) for p in (
+    r"(…|\.\.\.)?\s*(see|show) (more|less|all.*)",
+    r"(もっと見る|さらに表示|すべて表示|一部を表示|詳細を表示).*",
+    r"(connect|message|follow|more|pending|endorse|show credential)",
+    r"(つながりを申請|メッセージ|フォロー|フォロー中|推薦する|資格情報を表示)",
+    r"[\d,]+\+?\s*(followers?|connections?)",
+    r"(フォロワー|つながり)\s*[\d,]+\+?\s*(人|件)?",
+    r"(contact info|連絡先情報)",
+    r"page\s*\d+(\s*(/|of)\s*\d+)?",
+    r"\d+\s*of\s*\d+",
+    r"[-‐―]\s*\d+\s*[-‐―]",
+    r"(以上|end of (document|resume))",
+    r"(https?://|www\.)\S+",
+    r"(e-?mail|mail|tel|phone|電話|携帯|住所)\s*[:：].*",
+))
+# 素の "n/m" 行。2019/04 のような日付を落とさないよう、3 桁以内かつ n <= m の時だけページ番号とみなす
+_BARE_PAGE_RE = re.compile(r"(\d{1,3})\s*/\s*(\d{1,3})")
+# 見出し行（ここで新しいセクションを始める）
+_SECTION_HEAD_RE = re.compile(
+    r"^(about|summary|experience|work experience|education|skills?|licenses?( & certifications)?|"
+    r"certifications?|projects?|languages?|publications?|honors?( & awards)?|"
+    r"概要|自己紹介|自己pr|職歴|職務経歴|職務要約|経歴|学歴|スキル|保有スキル|資格|免許・資格|語学|"
+    r"プロジェクト|実績|受賞歴)\s*[:：]?$",
+    re.I,
+)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[。．！？!?])\s*|(?<=\.)\s+")
+
+
+def _profile_text(src: Any) -> str:
+    """linkedin_profile / resume（文字列 or JSON）をプレーンテキストに展開"""
+    if src is None:
+        return ""
+    if isinstance(src, str):
+        return src
+    if isinstance(src, dict):
+        parts = []
+        for key, val in src.items():
+            txt = _profile_text(val).strip()
+            if not txt:
+                continue
+            if key == "text":   # GAS からの {"text": "..."} はラベル不要
+                parts.append(txt)
+            else:
+                parts.append(f"{key}:\n{txt}" if "\n" in txt else f"{key}: {txt}")
+        return "\n\n".join(parts)
+    if isinstance(src, (list, tuple)):
+        return "\n".join(_profile_text(v) for v in src)
+    return str(src)
+
+
+def _normalize_profile(text: str) -> List[str]:
+    """NFKC → 行単位で空白整理・定型文除去・重複行除去。段落区切りは空文字で残す"""
+    text = unicodedata.normalize("NFKC", text).replace("\r\n", "\n").replace("\r", "\n")
+    lines: List[str] = []
+    seen = set()
+    for raw in text.split("\n"):
+        line = re.sub(r"[ \t\u3000]+", " ", raw).strip()
+        if not line:
+            if lines and lines[-1]:
+                lines.append("")
+            continue
+        if any(r.fullmatch(line) for r in _BOILERPLATE_RES):
+            continue
+        page = _BARE_PAGE_RE.fullmatch(line)
+        if page and int(page.group(1)) <= int(page.group(2)):
+            continue
+        key = _canon(line)
+        # 日付や役職名のような短い行は正当に繰り返されるので、長い行だけ重複を落とす
+        if len(key) >= 12:
+            if key in seen:
+                continue
+            seen.add(key)
+        lines.append(line)
+    return lines
+
+
+def _split_long(line: str, limit: int) -> List[str]:
+    """1 行が limit を超える場合は文単位、それでも長ければ文字数で割る"""
+    if approx_tokens(line) <= limit:
+        return [line]
+    out, cur = [], ""
+    for sent in (x for x in _SENTENCE_SPLIT_RE.split(line) if x):
+        while approx_tokens(sent) > limit:
+            cut = limit if not sent.isascii() else limit * 4
+            out.extend([cur] if cur else [])
+            cur = ""
+            out.append(sent[:cut])
+            sent = sent[cut:]
+        if cur and approx_tokens(cur) + approx_tokens(sent) > limit:
+            out.append(cur)
+            cur = ""
+        cur = f"{cur} {sent}".strip()
+    if cur:
+        out.append(cur)
+    return out
+
+
+def split_profile_chunks(text: str, chunk_tokens: int = _CHUNK_TOKENS) -> List[str]:
+    """
+    正規化済みテキストを意味のまとまり（見出し・段落単位、最大 chunk_tokens）に分割する。
+    内容が同じチャンク（別セクションへのコピペなど）は先に出た方だけ残す。
+    """
+    blocks: List[List[str]] = [[]]
+    for line in _normalize_profile(text):
+        if not line or _SECTION_HEAD_RE.match(line):
+            blocks.append([])
+        if line:
+            blocks[-1].append(line)
+
+    chunks: List[str] = []
+    for block in blocks:
+        cur: List[str] = []
+        for piece in (p for line in block for p in _split_long(line, chunk_tokens)):
+            if cur and approx_tokens("\n".join(cur + [piece])) > chunk_tokens:
+                chunks.append("\n".join(cur))
+                cur = []
+            cur.append(piece)
+        if cur:
+            chunks.append("\n".join(cur))
+
+    seen = set()
+    out = []
+    for c in chunks:
+        key = _canon(c)
+        if key and key not in seen:
+            seen.add(key)
+            out.append(c)
+    return out
+
+
+def _catalog_vocab() -> Dict[str, float]:
+    """カタログのスキル語彙 → idf（_catalog_index と同じタイミングで作り直す）"""
+    with _tenant()["lock"]:
+        index = _catalog_index()
+        if index.get("vocab") is None:
+            n = max(1, len(index["jobs"]))
+            index["vocab"] = {
+                term: float(np.log1p(n / len(rows)))
+                for term, rows in index["postings"].items()
+                if len(term) >= 2 and not term.isdigit()
+            }
+        return index["vocab"]
+
+
+def rank_profile_chunks(chunks: List[str], vocab: Dict[str, float]) -> List[int]:
+    """
+    チャンクを求人カタログとの関連度順に並べた index を返す。
+    関連度 = 含まれるスキル語彙の idf 合計 / sqrt(token 数)。同点は元の順（冒頭優先）。
+    """
+    scores = []
+    for c in chunks:
+        key = _canon(c)
+        hit = sum(w for term, w in vocab.items() if term in key)
+        scores.append(hit / np.sqrt(max(1, approx_tokens(c))))
+    return sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+
+
+def _prepare_chunks(text: str, budget_tokens: int) -> str:
+    chunks = split_profile_chunks(text)
+    vocab = _catalog_vocab()
+    picked, used = [], 0
+    for i in rank_profile_chunks(chunks, vocab):
+        cost = approx_tokens(chunks[i]) + 1
+        if used + cost <= budget_tokens:
+            picked.append(i)
+            used += cost
+    return "\n".join(chunks[i] for i in sorted(picked))
+
+
+def prepare_profile(src: Any, budget_tokens: int) -> str:
+    """
+    候補者プロフィール / 履歴書を embedding・プロンプト用に整える。
+    NFKC 正規化 → 定型文・重複除去 → チャンク分割 → カタログ関連度順に予算まで採用し、
+    元の並び順で連結して返す（文字数スライスのように途中で切らない）。
+    """
+    text = _profile_text(src)
+    if not text.strip():
+        return ""
+    _catalog_index()   # カタログ更新があれば先に反映してから版番号を読む
+    st = _tenant()
+    key = (text, budget_tokens, st["catalog"]["version"])
+    out = _cache_get(st, "profiles", key)
+    if out is None:
+        out = _prepare_chunks(text, budget_tokens)
+        _cache_put(st, "profiles", key, out, 2 * (len(text) + len(out)), PROFILE_CACHE_MAX)
+    return out
+
+
 # =========================
 # Health
 # =========================
@@ -119,6 +1145,19 @@ def match():
         return jsonify(error="candidate required"), 400
 
     cand = body["candidate"]
+    stream_fmt = _stream_format()
+    if stream_fmt:
+        try:
+            if mode == "inmail" or (mode == "scout" and body.get("prompt")):
+                events = inmail_flow_stream(body)
+            elif mode == "scout":
+                events = scout_flow_stream(cand)
+            else:
+                return jsonify(error="stream is supported for scout|inmail"), 400
+        except ValueError as ve:
+            return jsonify(error=str(ve)), 400
+        return _stream_response(events, stream_fmt)
+
     try:
         if mode == "inmail":
             result = inmail_flow(body)
@@ -139,41 +1178,72 @@ def match():
         return jsonify(error=str(e)), 500
 
 
+# =========================
+# Streaming (SSE / NDJSON)
+# =========================
+def _stream_format() -> str:
+    """?stream=sse|ndjson（1/true は sse）または Accept: text/event-stream で有効化"""
+    v = (request.args.get("stream") or "").lower()
+    if v in ("1", "true", "sse"):
+        return "sse"
+    if v in ("ndjson", "jsonl"):
+        return "ndjson"
+    if "text/event-stream" in (request.headers.get("Accept") or ""):
+        return "sse"
+    return ""
+
+
+def _stream_response(events, fmt: str) -> Response:
+    """
+    (event名, payload) のジェネレータをそのまま流す。
+    chunk はプレビュー用の生テキスト、result が整形・検証済みの最終結果。
+    途中で落ちた場合は error イベントで終える（HTTP ステータスは 200 のまま）。
+    """
+    def _encode(name: str, payload: Dict[str, Any]) -> str:
+        if fmt == "sse":
+            return f"event: {name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        return json.dumps({"event": name, "data": payload}, ensure_ascii=False) + "\n"
+
+    def _gen():
+        try:
+            for name, payload in events:
+                yield _encode(name, payload)
+        except Exception as e:
+            app.logger.exception("match() stream failed")
+            yield _encode("error", {"error": str(e)})
+
+    mimetype = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return Response(
+        stream_with_context(_gen()),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # =========================
 # Flows
 # =========================
-def scout_flow(cand: dict) -> Dict[str, Any]:
+FR_CALENDLY_URL = "https://calendly.com/k-nagase-tsugu/_linked-in-fr"
+
+
+def _scout_select(cand: dict) -> tuple:
+    """embedding 類似度 → Flash で 2 件選抜。返り値: (positions, click_score)"""
     jobs = load_jobs()
 
-    # 1) embedding 類似度
+    # 1) embedding 類似度（事前計算があればそれを使う）
     c_src = cand.get("linkedin_profile", "")
-    c_vec = embed(json.dumps(c_src))
-    sims = [(j, float(np.dot(c_vec, embed(j["summary"])))) for j in jobs]
-    top20 = sorted(sims, key=lambda x: -x[1])[:20]
-
-    # 2) 2.5 Flash で 2 件 pick（REST v1）
-    prompt = f"""
-下記候補者 LinkedIn と求人20件から、最もクリック率が高そうな2件だけ JSONで返して。
-キーは id,title,company_desc,salary の4項目のみ。
-### CAND
-{c_src}
-### JOBS
-{json.dumps([j for j, _ in top20], ensure_ascii=False)}
-""".strip()
+    ranked = precomputed_ranking(c_src, jobs)
+    if ranked is None:
+        c_vec = embed(_cand_text(c_src))
+        scores = job_vectors(jobs) @ c_vec if jobs else []
+        ranked = sorted(zip(jobs, map(float, scores)), key=lambda x: -x[1])
+    top20 = ranked[:20]
+
+    # 2) 2.5 Flash で 2 件 pick（REST v1 / 予算内の短縮ID表で渡す）
+    c_txt = prepare_profile(c_src, CAND_PROMPT_TOKEN_BUDGET)
+    prompt, mapping = build_scout_prompt(c_txt, [j for j, _ in top20], SCOUT_JOB_TOKEN_BUDGET)
     txt = strip_fence(_gen_text_v1(prompt, MODEL_FLASH))
-    try:
-        data = json.loads(txt)
-    except json.JSONDecodeError:
-        app.logger.warning("Flash JSON parse error: %s …", txt[:200])
-        data = []
-
-    # Flash が dict 形式 or list 形式どちらでも拾う
-    if isinstance(data, dict):
-        positions = data.get("selected_positions", [])[:2]
-    elif isinstance(data, list):
-        positions = data[:2]
-    else:
-        positions = []
+    positions = parse_scout_selection(txt, mapping)
 
     # フォールバック：何も取れなかったら類似度 Top2
     if not positions:
@@ -181,50 +1251,111 @@ def scout_flow(cand: dict) -> Dict[str, Any]:
 
     # 3) クリック率スコア（簡易）
     click = int(50 + 50 * np.tanh(sum(s for _, s in top20[:2])))
+    return positions[:2], click
+
+
+def _finalize_fr_note(note: str) -> str:
+    """URL保全 → 体裁正規化（空行除去）"""
+    note = _ensure_url_tail(note, FR_CALENDLY_URL, 300)
+    return _tidy_note(note)
+
+
+def scout_flow(cand: dict) -> Dict[str, Any]:
+    positions, click = _scout_select(cand)
 
     # 4) 友達申請メッセージをサーバ側で生成（300字以内）
     full_name = (cand.get("name") or "").strip()
-    fr_prompt = _build_friend_request_prompt(full_name, positions[:2])
+    fr_prompt = _build_friend_request_prompt(full_name, positions)
     try:
         note = _gen_text_v1(fr_prompt, MODEL_FLASH, temperature=0.4, max_tokens=320)
-        # URL保全 → 体裁正規化（空行除去）
-        note = _ensure_url_tail(note, "https://calendly.com/k-nagase-tsugu/_linked-in-fr", 300)
-        note = _tidy_note(note)
+        note = _finalize_fr_note(note)
     except Exception as e:
         app.logger.warning(f"[GEN-FR] fallback local due to {e}")
         # 最終フォールバック：ローカル整形（確実に返す）
-        note = _friend_request_local(full_name, positions[:2])
+        note = _friend_request_local(full_name, positions)
         note = _tidy_note(note)
 
     return {
-        "selected_positions": positions[:2],
+        "selected_positions": positions,
         "click_score": click,
         "friend_request_note": note
     }
 
 
+def scout_flow_stream(cand: dict):
+    """scout_flow のストリーミング版: meta → chunk* → result"""
+    positions, click = _scout_select(cand)
+    yield "meta", {"selected_positions": positions, "click_score": click}
+
+    full_name = (cand.get("name") or "").strip()
+    fr_prompt = _build_friend_request_prompt(full_name, positions)
+    parts: List[str] = []
+    try:
+        for chunk in _stream_text_v1(fr_prompt, MODEL_FLASH, temperature=0.4, max_tokens=320):
+            parts.append(chunk)
+            yield "chunk", {"text": chunk}
+        note = _finalize_fr_note("".join(parts).strip())
+    except Exception as e:
+        app.logger.warning(f"[GEN-FR] stream fallback local due to {e}")
+        note = _tidy_note(_friend_request_local(full_name, positions))
+
+    yield "result", {
+        "selected_positions": positions,
+        "click_score": click,
+        "friend_request_note": note
+    }
+
+
+def build_scout_prompt(c_src: Any, ranked_jobs: List[Dict[str, Any]], budget_tokens: int) -> tuple:
+    """scout の 2 件選抜プロンプト。返り値: (prompt, {短縮ID: 元レコード})"""
+    table, mapping = build_job_table(ranked_jobs, budget_tokens)
+    prompt = f"""
+下記候補者 LinkedIn と求人表（類似度順）から、最もクリック率が高そうな2件だけ JSON配列で返して。
+要素のキーは id,company_desc の2項目のみ。id は表の先頭列（J1 など）をそのまま使う。
+### CAND
+{c_src}
+### JOBS
+{table}
+""".strip()
+    return prompt, mapping
+
+
+def parse_scout_selection(txt: str, mapping: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """選抜結果 JSON を元レコードへ復元（dict 形式 or list 形式どちらでも拾う）"""
+    try:
+        data = json.loads(txt)
+    except json.JSONDecodeError:
+        app.logger.warning("Flash JSON parse error: %s …", txt[:200])
+        return []
+    if isinstance(data, dict):
+        data = data.get("selected_positions", [])
+    return restore_jobs(data, mapping)[:2]
+
+
 def proposal_flow(cand: dict) -> Dict[str, Any]:
-    jobs = load_jobs()
-    must = str(cand.get("must", "")).strip()
-
-    # 1) 年収フィルタ（最低年収のような使い方、ざっくり）
-    filtered = jobs
-    if must.isdigit():
-        filtered = [
-            j for j in jobs
-            if j["salary"] and j["salary"][:4].isdigit()
-            and int(must) <= int(j["salary"][:4])
-        ][:50]
-
-    # 2) 2.5 Flash で ID 絞り込み
+    raw_must = cand.get("must", "")
+    must = (
+        json.dumps(raw_must, ensure_ascii=False)
+        if isinstance(raw_must, dict) else str(raw_must).strip()
+    )
+
+    resume = prepare_profile(cand.get("resume", ""), CAND_PROMPT_TOKEN_BUDGET)
+
+    # 1) ローカル事前フィルタ（年収 / 勤務地 / ステータス / スキル）で Gemini に渡す件数を絞る
+    filtered = filter_jobs(parse_must(raw_must), limit=PROPOSAL_PREFILTER_MAX)
+    if not filtered:
+        return {"selected_positions": []}
+
+    # 2) 2.5 Flash で ID 絞り込み（予算内の短縮ID表で渡す）
+    table, mapping = build_job_table(filtered, PROPOSAL_JOB_TOKEN_BUDGET)
     flash_p = f"""
-候補者履歴書と求人リスト。must条件を満たさない求人は除外し、20件以内に絞ってID配列を返せ
+候補者履歴書と求人表。must条件を満たさない求人は除外し、20件以内に絞ってID配列を返せ（ID は表の先頭列 J1 などをそのまま使う）
 ### MUST
 {must}
 ### CAND
-{cand.get('resume', '')[:1500]}
+{resume}
 ### JOBS
-{json.dumps(filtered, ensure_ascii=False)}
+{table}
 """.strip()
     keep_ids_json = strip_fence(_gen_text_v1(flash_p, MODEL_FLASH))
     try:
@@ -232,19 +1363,21 @@ def proposal_flow(cand: dict) -> Dict[str, Any]:
     except Exception:
         app.logger.warning("Flash keep_ids parse error: %s …", keep_ids_json[:200])
         keep_ids = []
-    subset = [j for j in filtered if j["id"] in keep_ids][:20]
+    subset = restore_jobs(keep_ids, mapping)[:20]
 
     # 3) 2.5 Flash でスコアリング（REST v1）
+    table, mapping = build_job_table(subset, PROPOSAL_JOB_TOKEN_BUDGET)
     pro_p = f"""
-候補者要約と求人を読み、overall_score,candidate_fit,company_fit を100点満点で付与し JSON配列返却。
+候補者要約と求人表を読み、各求人に overall_score,candidate_fit,company_fit を100点満点で付与し JSON配列返却。
+各要素は id（表の先頭列 J1 など）と3つのスコアのみ。
 ### CAND
-{cand.get('resume', '')[:2000]}
+{resume}
 ### JOBS
-{json.dumps(subset, ensure_ascii=False)}
+{table}
 """.strip()
     scored_json = strip_fence(_gen_text_v1(pro_p, MODEL_FLASH))
     try:
-        scored = json.loads(scored_json)
+        scored = restore_jobs(json.loads(scored_json), mapping)
         scored = sorted(scored, key=lambda x: -x.get("overall_score", 0))[:5]
     except Exception:
         app.logger.warning("Flash scoring parse error: %s …", scored_json[:200])
@@ -252,8 +1385,8 @@ def proposal_flow(cand: dict) -> Dict[str, Any]:
     return {"selected_positions": scored}
 
 
-def inmail_flow(body: dict) -> Dict[str, Any]:
-    """Generate inMail content via Gemini using a pre-built prompt from GAS."""
+def _inmail_params(body: dict) -> tuple:
+    """inmail 用の (prompt, temperature, max_output) を取り出す"""
     prompt = body.get("prompt", "")
     if not isinstance(prompt, str) or not prompt.strip():
         raise ValueError("prompt required for inmail flow")
@@ -276,8 +1409,32 @@ def inmail_flow(body: dict) -> Dict[str, Any]:
         max_output = int(max_output)
     except Exception:
         max_output = 1024
+    return prompt, temperature, max_output
 
+
+def inmail_flow(body: dict) -> Dict[str, Any]:
+    """Generate inMail content via Gemini using a pre-built prompt from GAS."""
+    prompt, temperature, max_output = _inmail_params(body)
     raw = _gen_text_v1(prompt, MODEL_FLASH, temperature=temperature, max_tokens=max_output)
+    return _parse_inmail(raw)
+
+
+def inmail_flow_stream(body: dict):
+    """inmail_flow のストリーミング版: chunk* → result（検証は組み立て後の全文に対して行う）"""
+    prompt, temperature, max_output = _inmail_params(body)
+
+    def _events():
+        parts: List[str] = []
+        for chunk in _stream_text_v1(prompt, MODEL_FLASH, temperature=temperature, max_tokens=max_output):
+            parts.append(chunk)
+            yield "chunk", {"text": chunk}
+        yield "result", _parse_inmail("".join(parts))
+
+    return _events()
+
+
+def _parse_inmail(raw: str) -> Dict[str, Any]:
+    """生成テキストを inMail JSON として検証・正規化"""
     clean = strip_fence(raw)
     try:
         parsed = json.loads(clean)
@@ -502,14 +1659,302 @@ def _to_vec(resp):
     raise ValueError(f"Unexpected embedding response shape: {type(resp)} -> {resp}")
 
 def _embed_once(text: str):
-    # v1 Client で contents= フォーマット
-    r = CLIENT.models.embed_content(
-        model="text-embedding-004",
-        contents=[{"role": "user", "parts": [{"text": text}]}],
+    # v1 Client で contents= フォーマット（429 / 5xx は共通ポリシーで再試行）
+    r = call_with_retry(
+        lambda: CLIENT.models.embed_content(
+            model="text-embedding-004",
+            contents=[{"role": "user", "parts": [{"text": text}]}],
+        ),
+        key=_API_KEY,
+        label="EMBED",
     )
     return _to_vec(r)
 
 
+def _embed_batch(texts: List[str], batch: int = 100) -> np.ndarray:
+    """batchEmbedContents 相当（1 リクエスト最大 100 件）で [n, dim] を返す"""
+    out = []
+    for i in range(0, len(texts), batch):
+        chunk = texts[i:i + batch]
+        r = call_with_retry(
+            lambda: CLIENT.models.embed_content(
+                model="text-embedding-004",
+                contents=[{"role": "user", "parts": [{"text": t}]} for t in chunk],
+            ),
+            key=_API_KEY,
+            label="EMBED-BATCH",
+        )
+        out.extend(list(e.values) for e in r.embeddings)
+    return np.array(out, dtype=np.float32)
+
+
+# =========================
+# Precomputed match matrix (background)
+# =========================
+PRECOMPUTE_PATH = os.getenv("PRECOMPUTE_PATH", "/tmp/match_topk.npz")   # gs://bucket/obj も可（default テナント）
+PRECOMPUTE_TOPK = int(os.getenv("PRECOMPUTE_TOPK", "20"))
+PRECOMPUTE_BLOCK = int(os.getenv("PRECOMPUTE_BLOCK", "512"))           # matmul の行ブロック
+PRECOMPUTE_RELOAD_SEC = int(os.getenv("PRECOMPUTE_RELOAD_SEC", "300"))
+PRECOMPUTE_TOKEN = os.getenv("PRECOMPUTE_TOKEN", "")
+# 事前計算結果を引くのは scout（プロンプト無し）= GAS friend_request.js だけなので、既定はそのシート
+CANDIDATE_SHEET = os.getenv("CANDIDATE_SHEET", "Friend_Request")
+
+def _precompute_path() -> str:
+    """テナントの保存先（未設定なら PRECOMPUTE_PATH にテナント名を挟む）"""
+    st = _tenant()
+    if st["conf"]["precompute_path"]:
+        return st["conf"]["precompute_path"]
+    if st["name"] == DEFAULT_TENANT:
+        return PRECOMPUTE_PATH
+    root, ext = os.path.splitext(PRECOMPUTE_PATH)
+    return f"{root}.{_tenant_dir(st)}{ext}"
+
+
+def _sha1(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _cand_key(c_src: Any) -> str:
+    """事前計算結果の候補者キー（生プロフィールのハッシュ。行の検索用）"""
+    return _sha1(json.dumps(c_src))
+
+
+def _cand_text(c_src: Any) -> str:
+    """候補者の embedding 入力（前処理済み・CAND_EMBED_TOKEN_BUDGET 以内）"""
+    return prepare_profile(c_src, CAND_EMBED_TOKEN_BUDGET) or json.dumps(c_src)
+
+
+def _read_bytes(path: str) -> bytes:
+    if path.startswith("gs://"):
+        from google.cloud import storage
+        bucket, blob = path[5:].split("/", 1)
+        return storage.Client().bucket(bucket).blob(blob).download_as_bytes()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_bytes(path: str, data: bytes) -> None:
+    if path.startswith("gs://"):
+        from google.cloud import storage
+        bucket, blob = path[5:].split("/", 1)
+        storage.Client().bucket(bucket).blob(blob).upload_from_string(data)
+        return
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)   # 読み手が途中のファイルを掴まないように
+
+
+def _load_npz(path: str) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(_read_bytes(path)), allow_pickle=False) as z:
+        return {k: z[k] for k in z.files}
+
+
+def _load_candidates() -> List[tuple]:
+    """
+    Friend_Request!A:E（A: 氏名 / B: プロフィール / E: Status）→ [(name, c_src)]。
+    GAS は Status が入った行を飛ばすので、まだ処理されていない行だけ事前計算する。
+    """
+    with _SHEETS_LOCK:
+        vals = (
+            sheets.spreadsheets()
+            .values()
+            .get(spreadsheetId=_tenant()["conf"]["sheet_id"], range=f"{CANDIDATE_SHEET}!A:E")
+            .execute()
+            .get("values", [])
+        )
+    return [
+        (r[0], {"text": r[1].strip()})   # GAS friend_request と同じ payload 形
+        for r in vals[1:]
+        if len(r) > 1 and r[1].strip() and not (len(r) > 4 and str(r[4]).strip())
+    ]
+
+
+def _topk_rows(c_vecs: np.ndarray, j_vecs: np.ndarray, k: int) -> tuple:
+    """候補者 × 求人 の類似度を行ブロックごとに計算し、各行の top-K を返す"""
+    n = len(c_vecs)
+    k = min(k, j_vecs.shape[0])
+    top_idx = np.zeros((n, k), dtype=np.int32)
+    top_score = np.zeros((n, k), dtype=np.float32)
+    if n == 0 or k == 0:
+        return top_idx, top_score
+    for start in range(0, n, PRECOMPUTE_BLOCK):
+        sim = c_vecs[start:start + PRECOMPUTE_BLOCK] @ j_vecs.T
+        part = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+        part_score = np.take_along_axis(sim, part, axis=1)
+        order = np.argsort(-part_score, axis=1)
+        top_idx[start:start + len(sim)] = np.take_along_axis(part, order, axis=1)
+        top_score[start:start + len(sim)] = np.take_along_axis(part_score, order, axis=1)
+    return top_idx, top_score
+
+
+def _reuse_or_embed(keys: List[str], texts: List[str], prev_keys, prev_vecs) -> tuple:
+    """前回と同じキー（内容ハッシュ）の行は再利用し、残りだけ batch embed"""
+    prev = {k: i for i, k in enumerate(prev_keys)} if prev_keys is not None else {}
+    todo = [i for i, k in enumerate(keys) if k not in prev]
+    fresh = _embed_batch([texts[i] for i in todo]) if todo else None
+    dim = fresh.shape[1] if fresh is not None else (prev_vecs.shape[1] if prev else 0)
+    vecs = np.zeros((len(keys), dim), dtype=np.float32)
+    for i, k in enumerate(keys):
+        if k in prev:
+            vecs[i] = prev_vecs[prev[k]]
+    if todo:
+        vecs[todo] = fresh
+    return vecs, len(todo)
+
+
+def precompute_matches(full: bool = False) -> Dict[str, Any]:
+    """
+    Friend_Request の未処理行 × 募集中求人 の top-K を計算してテナントの保存先に書き出す。
+    求人ベクトルは /match と同じカタログ行列（job_vectors）を使い、候補者の embedding は
+    前処理後テキストが同じなら前回ファイルから再利用する。求人側に変更がなければ
+    新規・変更のあった候補者の行だけ計算し直す。
+    """
+    t0 = time.time()
+    st = _tenant()
+    with st["lock"]:
+        st["catalog"]["loaded_at"] = 0.0
+        st["snap"]["checked_at"] = 0.0
+    path = _precompute_path()
+    jobs = load_jobs()
+    cands = _load_candidates()
+
+    prev = None
+    if not full:
+        try:
+            prev = _load_npz(path)
+        except Exception as e:
+            print(f"[PRECOMPUTE] no previous result ({e}); full rebuild")
+
+    job_ids = [str(j["id"]) for j in jobs]
+    job_keys = [_sha1(f"{j['id']}\t{j['summary']}") for j in jobs]
+    cand_texts = [_cand_text(c) for _, c in cands]
+    cand_keys = [_cand_key(c) for _, c in cands]
+    # embedding の再利用キーは前処理後テキストのハッシュ（カタログ変更で入力が変われば作り直す）
+    embed_keys = [_sha1(t) for t in cand_texts]
+
+    j_vecs = job_vectors(jobs)
+    # 前処理導入前のファイル（cand_embed_keys 無し）は生テキストの embedding なので使わない
+    prev_embed_keys = prev.get("cand_embed_keys") if prev else None
+    c_vecs, c_new = _reuse_or_embed(
+        embed_keys, cand_texts,
+        prev_embed_keys, prev["cand_vecs"] if prev_embed_keys is not None else None,
+    )
+
+    jobs_same = prev is not None and list(prev["job_keys"]) == job_keys
+    if jobs_same and prev["top_idx"].shape[1] == min(PRECOMPUTE_TOPK, len(jobs)):
+        prev_row = (
+            {(k, e): i for i, (k, e) in enumerate(zip(prev["cand_keys"], prev_embed_keys))}
+            if prev_embed_keys is not None else {}
+        )
+        pairs = list(zip(cand_keys, embed_keys))
+        rows = [i for i, kv in enumerate(pairs) if kv not in prev_row]
+        top_idx = np.zeros((len(cand_keys), prev["top_idx"].shape[1]), dtype=np.int32)
+        top_score = np.zeros(top_idx.shape, dtype=np.float32)
+        for i, kv in enumerate(pairs):
+            if kv in prev_row:
+                top_idx[i] = prev["top_idx"][prev_row[kv]]
+                top_score[i] = prev["top_score"][prev_row[kv]]
+        if rows:
+            top_idx[rows], top_score[rows] = _topk_rows(c_vecs[rows], j_vecs, PRECOMPUTE_TOPK)
+    else:
+        rows = list(range(len(cand_keys)))
+        top_idx, top_score = _topk_rows(c_vecs, j_vecs, PRECOMPUTE_TOPK)
+
+    buf = io.BytesIO()
+    np.savez_compressed(
+        buf,
+        job_ids=np.array(job_ids, dtype=str),
+        job_keys=np.array(job_keys, dtype=str),
+        cand_keys=np.array(cand_keys, dtype=str),
+        cand_embed_keys=np.array(embed_keys, dtype=str),
+        cand_vecs=c_vecs,
+        top_idx=top_idx,
+        top_score=top_score,
+        built_at=np.array(time.time()),
+    )
+    _write_bytes(path, buf.getvalue())
+    st["precomp"]["checked_at"] = 0.0   # 次のリクエストで読み直す
+
+    stats = {
+        "tenant": st["name"],
+        "candidates": len(cand_keys),
+        "jobs": len(job_ids),
+        "embedded_candidates": c_new,
+        "rows_recomputed": len(rows),
+        "sec": round(time.time() - t0, 2),
+    }
+    print(f"[PRECOMPUTE] {json.dumps(stats)}")
+    return stats
+
+
+def _precomputed() -> Dict[str, Any]:
+    """保存済み top-K を PRECOMPUTE_RELOAD_SEC ごとに読み直してキャッシュ"""
+    st = _tenant()
+    state = st["precomp"]
+    with st["lock"]:
+        now = time.time()
+        if now - state["checked_at"] < PRECOMPUTE_RELOAD_SEC:
+            return state["data"]
+        state["checked_at"] = now
+        try:
+            z = _load_npz(_precompute_path())
+            if "cand_embed_keys" not in z:
+                raise ValueError("built before profile preprocessing; run precompute again")
+            state["data"] = {
+                "row": {k: i for i, k in enumerate(z["cand_keys"])},
+                "embed_keys": z["cand_embed_keys"],
+                "job_ids": z["job_ids"],
+                "top_idx": z["top_idx"],
+                "top_score": z["top_score"],
+            }
+        except FileNotFoundError:
+            state["data"] = None
+        except Exception as e:
+            print(f"[PRECOMPUTE] load failed: {e}")
+        return state["data"]
+
+
+def precomputed_ranking(c_src: Any, jobs: List[Dict[str, Any]]) -> List[tuple]:
+    """
+    事前計算済みの [(job, score)]（類似度降順）を返す。候補者が未計算、
+    または現在の募集中求人に残っているものが無ければ None。
+    """
+    data = _precomputed()
+    if not data:
+        return None
+    row = data["row"].get(_cand_key(c_src))
+    # 前処理後テキストが事前計算時と違えば（カタログ更新など）その場で計算し直す
+    if row is None or data["embed_keys"][row] != _sha1(_cand_text(c_src)):
+        return None
+    by_id = {str(j["id"]): j for j in jobs}
+    ranked = [
+        (by_id[data["job_ids"][i]], float(sc))
+        for i, sc in zip(data["top_idx"][row], data["top_score"][row])
+        if data["job_ids"][i] in by_id
+    ]
+    return ranked or None
+
+
+# admission control とは別の専用枠（同時に走らせるのは 1 本だけ）
+_PRECOMPUTE_SLOT = threading.Lock()
+
+
+@app.route("/precompute", methods=["POST"])
+def precompute_endpoint():
+    """Cloud Scheduler などから叩く再計算エンドポイント（?full=1 で全再計算）"""
+    # 未認証公開のサービスなので、トークン未設定なら常に拒否（CLI の python main.py precompute は使える）
+    if not PRECOMPUTE_TOKEN or request.headers.get("X-Precompute-Token") != PRECOMPUTE_TOKEN:
+        return jsonify(error="forbidden"), 403
+    if not _PRECOMPUTE_SLOT.acquire(blocking=False):
+        return jsonify(error="precompute already running"), 429, {"Retry-After": "60"}
+    try:
+        full = (request.args.get("full") or "").lower() in ("1", "true")
+        return jsonify(precompute_matches(full=full)), 200
+    finally:
+        _PRECOMPUTE_SLOT.release()
+
+
 # =========================
 # v1 Models helper
 # =========================
@@ -580,6 +2025,30 @@ def _pick_model_for_generate():
 # =========================
 # v1 Text generation (timeout & fallback)
 # =========================
+def _post_with_retry(post, deadline: float, label: str):
+    """
+    429 / 5xx だけ共通ポリシーで再試行する（Retry-After 尊重）。
+    タイムアウトはここでは再試行せず、呼び出し側の flash-lite フォールバックに任せる。
+    """
+    def _once():
+        response = post()
+        if response.status_code in RETRYABLE_STATUS:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            raise RetryableError(
+                f"HTTP {response.status_code}", retry_after=retry_after, status=response.status_code
+            )
+        return response
+
+    return call_with_retry(
+        _once,
+        key=_API_KEY,
+        deadline=deadline,
+        classify=lambda e: isinstance(e, RetryableError),
+        label=label,
+    )
+
+
 def _gen_text_v1(
     prompt: str,
     model: str = None,
@@ -642,11 +2111,17 @@ def _gen_text_v1(
         )
         return requests.post(url, json=body, timeout=(10, 60))
 
+    # 全モデル合計での再試行時間の上限（フォールバック先への切替は上限外）
+    deadline = deadline_after()
+
     def _try_model(model_name: str, version: str):
-        response = _post(model_name, version)
-        if response.status_code in (429, 500, 503):
-            time.sleep(0.5)
-            response = _post(model_name, version)
+        try:
+            response = _post_with_retry(
+                lambda: _post(model_name, version), deadline, f"GEN {model_name}@{version}"
+            )
+        except RetryableError as e:
+            print(f"[GEN] {model_name}@{version} -> gave up ({e})")
+            return None, False
         if not response.ok:
             print(f"[GEN] {model_name}@{version} -> {response.status_code} {response.text[:300]}")
             return None, response.status_code == 404
@@ -694,6 +2169,82 @@ def _gen_text_v1(
     raise RuntimeError(f"REST v1 generateContent failed{detail}")
 
 
+def _stream_text_v1(
+    prompt: str,
+    model: str = None,
+    temperature: float = 0.4,
+    max_tokens: int = 512
+):
+    """
+    REST v1 streamGenerateContent（alt=sse）で本文をチャンクごとに yield する。
+    最初のチャンクを返す前の失敗だけ次のモデルへフォールバックし、
+    途中で切れた場合はそのまま例外を上げる（呼び出し側で最終結果を組み立て直す）。
+    """
+    import requests
+
+    if not _API_KEY:
+        raise RuntimeError("GEMINI_API_KEY/GOOGLE_API_KEY is not set")
+
+    candidates: List[str] = []
+    for mdl in (model, MODEL_FLASH, "gemini-2.5-flash", "gemini-2.5-flash-lite"):
+        if mdl and mdl not in candidates:
+            candidates.append(mdl)
+
+    body = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {"temperature": temperature, "maxOutputTokens": max_tokens},
+    }
+
+    def _post(model_name: str):
+        url = (
+            "https://generativelanguage.googleapis.com/"
+            f"v1/models/{model_name}:streamGenerateContent?alt=sse&key={_API_KEY}"
+        )
+        return requests.post(url, json=body, timeout=(10, 60), stream=True)
+
+    def _chunks(response):
+        response.encoding = "utf-8"
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = json.loads(line[5:].strip())
+            for cand in data.get("candidates") or []:
+                for part in (cand.get("content") or {}).get("parts") or []:
+                    if isinstance(part, dict) and part.get("text"):
+                        yield part["text"]
+
+    deadline = deadline_after()
+    last_error = None
+    for mdl in candidates:
+        try:
+            response = _post_with_retry(lambda: _post(mdl), deadline, f"GEN-STREAM {mdl}")
+            if not response.ok:
+                print(f"[GEN-STREAM] {mdl} -> {response.status_code} {response.text[:300]}")
+                last_error = f"{mdl} {response.status_code}"
+                continue
+        except requests.exceptions.Timeout:
+            print(f"[GEN-STREAM] {mdl} -> Timeout")
+            last_error = f"{mdl} Timeout"
+            continue
+        except RetryableError as e:
+            print(f"[GEN-STREAM] {mdl} -> gave up ({e})")
+            last_error = f"{mdl} {e}"
+            continue
+
+        emitted = False
+        with response:
+            for text in _chunks(response):
+                emitted = True
+                yield text
+        if emitted:
+            print(f"[GEN-STREAM] ok via {mdl}")
+            return
+        print(f"[GEN-STREAM] {mdl} -> empty stream")
+        last_error = f"{mdl} empty"
+
+    raise RuntimeError(f"REST v1 streamGenerateContent failed after candidates={candidates}; last={last_error}")
+
+
 # =========================
 # Debug endpoint
 # =========================
@@ -737,4 +2288,13 @@ def _app_error(e):
 # Local debug
 # =========================
 if __name__ == "__main__":
-    app.run("0.0.0.0", port=8080, debug=True)
+    import sys
+    if sys.argv[1:2] == ["precompute"]:
+        # python main.py precompute [--full] [--tenant NAME]
+        args = sys.argv[2:]
+        name = args[args.index("--tenant") + 1] if "--tenant" in args else DEFAULT_TENANT
+        with app.app_context():
+            g.tenant = tenant_state(name)
+            precompute_matches(full="--full" in args)
+    else:
+        app.run("0.0.0.0", port=8080, debug=True)
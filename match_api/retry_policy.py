@@ -0,0 +1,180 @@
+# retry_policy.py – Gemini / Google API 呼び出しの共通リトライ & レート制御
+#
+#   match_api / pdf_ingest はそれぞれ単体ディレクトリで Cloud Run にデプロイするため、
+#   両方に同じ内容のファイルを置いている（ずれは .github/workflows/shared-modules.yml が検出）。
+#
+#   - エラーを retryable / permanent に分類（429・5xx・タイムアウトだけ再試行）
+#   - decorrelated jitter バックオフ（Retry-After があればそれ以上待つ）
+#   - API キー単位の token bucket でクライアント側レート制限
+#   - 1 呼び出しあたりの再試行合計時間に上限（deadline）
+import os
+import time
+import random
+import threading
+import email.utils
+from typing import Any, Callable, Dict, Optional
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+RETRY_BASE_SEC = float(os.getenv("RETRY_BASE_SEC", "0.5"))
+RETRY_CAP_SEC = float(os.getenv("RETRY_CAP_SEC", "20"))
+RETRY_BUDGET_SEC = float(os.getenv("RETRY_BUDGET_SEC", "45"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+GEMINI_RATE_PER_SEC = float(os.getenv("GEMINI_RATE_PER_SEC", "2"))
+GEMINI_RATE_BURST = float(os.getenv("GEMINI_RATE_BURST", "4"))
+
+
+class RetryableError(Exception):
+    """一時的な失敗（429 / 5xx / タイムアウト）。retry_after は秒"""
+
+    def __init__(self, msg: str, retry_after: Optional[float] = None, status: Optional[int] = None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class PermanentError(Exception):
+    """再試行しても結果が変わらない失敗（4xx / JSON 形状不一致など）"""
+
+
+def parse_retry_after(value: Any) -> Optional[float]:
+    """Retry-After ヘッダ（秒数 or HTTP-date）を秒に変換"""
+    if value in (None, ""):
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(str(value))
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _status_of(exc: BaseException) -> Optional[int]:
+    """requests / google.api_core / google-genai 例外から HTTP ステータスを拾う"""
+    resp = getattr(exc, "response", None)
+    code = getattr(resp, "status_code", None)
+    if isinstance(code, int):
+        return code
+    for attr in ("code", "status_code"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """例外を retryable / permanent に分類する"""
+    if isinstance(exc, RetryableError):
+        return True
+    if isinstance(exc, (PermanentError, ValueError, KeyError, TypeError)):
+        return False   # json.JSONDecodeError は ValueError のサブクラス
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    status = _status_of(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # requests.exceptions.Timeout / ConnectionError は名前で判定（import 不要にする）
+    name = type(exc).__name__
+    return any(k in name for k in ("Timeout", "ConnectionError", "ServiceUnavailable", "ResourceExhausted"))
+
+
+def _retry_after_of(exc: BaseException) -> Optional[float]:
+    if isinstance(exc, RetryableError):
+        return exc.retry_after
+    resp = getattr(exc, "response", None)
+    headers = getattr(resp, "headers", None) or {}
+    try:
+        return parse_retry_after(headers.get("Retry-After"))
+    except AttributeError:
+        return None
+
+
+class TokenBucket:
+    """単純な token bucket（rate: 1 秒あたり補充数 / burst: 最大保持数）"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline: Optional[float] = None) -> None:
+        """1 トークン取れるまで待つ。deadline を越えるなら RetryableError"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RetryableError("client-side rate limit: deadline exceeded", retry_after=wait)
+            time.sleep(wait)
+
+
+_BUCKETS: Dict[str, TokenBucket] = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def bucket_for(key: str) -> TokenBucket:
+    """API キー（またはサービスアカウント）ごとに 1 つの bucket を共有"""
+    with _BUCKETS_LOCK:
+        b = _BUCKETS.get(key)
+        if b is None:
+            b = _BUCKETS[key] = TokenBucket(GEMINI_RATE_PER_SEC, GEMINI_RATE_BURST)
+        return b
+
+
+def deadline_after(sec: float = None) -> float:
+    """call_with_retry に渡す絶対期限（time.monotonic 基準）"""
+    return time.monotonic() + (RETRY_BUDGET_SEC if sec is None else sec)
+
+
+def call_with_retry(
+    fn: Callable[[], Any],
+    *,
+    key: str = "default",
+    deadline: Optional[float] = None,
+    max_attempts: int = None,
+    classify: Callable[[BaseException], bool] = is_retryable,
+    label: str = "call",
+) -> Any:
+    """
+    fn() を retryable なエラー（classify が True）の間だけ再試行する。
+    待ち時間は decorrelated jitter（min(cap, U(base, prev*3))）と Retry-After の大きい方。
+    permanent なエラー、試行回数超過、deadline 超過のときは最後の例外をそのまま上げる。
+    """
+    if deadline is None:
+        deadline = deadline_after()
+    attempts = max_attempts or RETRY_MAX_ATTEMPTS
+    bucket = bucket_for(key)
+    sleep = RETRY_BASE_SEC
+    last: Optional[Exception] = None
+    for n in range(1, attempts + 1):
+        try:
+            bucket.acquire(deadline)
+        except RetryableError:
+            if last is not None:   # 期限切れなら直前の本来のエラーを返す
+                raise last
+            raise
+        try:
+            return fn()
+        except Exception as e:
+            last = e
+            if not classify(e) or n == attempts:
+                raise
+            sleep = min(RETRY_CAP_SEC, random.uniform(RETRY_BASE_SEC, sleep * 3))
+            wait = max(sleep, _retry_after_of(e) or 0.0)
+            if time.monotonic() + wait > deadline:
+                print(f"[RETRY] {label}: budget exhausted after {n} attempts ({e})")
+                raise
+            print(f"[RETRY] {label}: attempt {n} failed ({e}); sleep {wait:.2f}s")
+            time.sleep(wait)
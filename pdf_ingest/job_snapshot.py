@@ -0,0 +1,282 @@
+# job_snapshot.py – Job_Database の列指向スナップショット（pdf_ingest が書き、match_api が読む）
+#
+#   match_api / pdf_ingest はそれぞれ単体ディレクトリで Cloud Run にデプロイするため、
+#   両方に同じ内容のファイルを置いている（ずれは .github/workflows/shared-modules.yml が検出）。
+#
+#   レイアウト（JOB_SNAPSHOT_URI = gs://bucket/prefix もしくはローカルディレクトリ）
+#     {uri}/LATEST                       {"version": n, "rows": k, "dim": d, "built_at": ts}
+#     {uri}/v{n:08d}/columns.npz         列ごとの UTF-8 連結バイト列 + offsets（文字列テーブル）
+#     {uri}/v{n:08d}/embeddings.npy      summary の embedding [k, d] float32（mmap で読む）
+#
+#   version ディレクトリを書き終えてから LATEST を差し替えるので、
+#   読み手が書きかけの版を掴むことはない。書き手は pdf_ingest（PDF 取り込みと定期同期）だけだが、
+#   複数インスタンスが同時に書いても LATEST は generation 条件付きで進めるので古い版へ巻き戻らない。
+import os
+import io
+import json
+import time
+import hashlib
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+# Job_Database A:K の列名（match_api の求人 dict と同じキー）
+COLUMNS = (
+    "id", "company", "title", "status", "summary", "loc", "salary",
+    "required_skills", "preferred_skills", "ideal_profile", "appeal_points",
+)
+KEEP_VERSIONS = 3
+
+
+# ─────────────────────────────
+# ストレージ（gs:// or ローカル）
+# ─────────────────────────────
+def _split_gs(uri: str) -> tuple:
+    bucket, _, prefix = uri[5:].partition("/")
+    return bucket, prefix.rstrip("/")
+
+
+def _read(uri: str, name: str) -> Optional[bytes]:
+    if uri.startswith("gs://"):
+        from google.cloud import storage
+        bucket, prefix = _split_gs(uri)
+        blob = storage.Client().bucket(bucket).blob(f"{prefix}/{name}" if prefix else name)
+        return blob.download_as_bytes() if blob.exists() else None
+    path = os.path.join(uri, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write(uri: str, name: str, data: bytes, create_only: bool = False) -> None:
+    """create_only=True のとき既存なら FileExistsError（版番号の衝突検出用）"""
+    if uri.startswith("gs://"):
+        from google.cloud import storage
+        from google.api_core.exceptions import PreconditionFailed
+        bucket, prefix = _split_gs(uri)
+        blob = storage.Client().bucket(bucket).blob(f"{prefix}/{name}" if prefix else name)
+        try:
+            blob.upload_from_string(data, if_generation_match=0 if create_only else None)
+        except PreconditionFailed as e:
+            raise FileExistsError(f"{uri}/{name}") from e
+        return
+    path = os.path.join(uri, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if create_only:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _delete_version(uri: str, version: int) -> None:
+    vdir = f"v{version:08d}"
+    try:
+        if uri.startswith("gs://"):
+            from google.cloud import storage
+            bucket, prefix = _split_gs(uri)
+            b = storage.Client().bucket(bucket)
+            for blob in b.list_blobs(prefix=f"{prefix}/{vdir}/" if prefix else f"{vdir}/"):
+                blob.delete()
+        else:
+            import shutil
+            shutil.rmtree(os.path.join(uri, vdir), ignore_errors=True)
+    except Exception as e:
+        print(f"[Snapshot] cleanup v{version} failed: {e}")
+
+
+# ─────────────────────────────
+# 文字列テーブル
+# ─────────────────────────────
+def _pack_strings(values: List[str]) -> tuple:
+    blobs = [str(v or "").encode("utf-8") for v in values]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+    return np.frombuffer(b"".join(blobs), dtype=np.uint8), offsets
+
+
+def _unpack_strings(data: np.ndarray, offsets: np.ndarray) -> List[str]:
+    raw = data.tobytes()
+    return [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def summary_hash(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+def rows_to_records(rows: List[List[Any]]) -> List[Dict[str, str]]:
+    """Sheets の values（ヘッダー除外済み）→ 列名付き dict。A:C が揃わない行は捨てる"""
+    return [
+        {col: (str(r[i]) if i < len(r) else "") for i, col in enumerate(COLUMNS)}
+        for r in rows
+        if len(r) >= 3 and r[0]
+    ]
+
+
+# ─────────────────────────────
+# 読み書き
+# ─────────────────────────────
+def read_latest(uri: str) -> Optional[Dict[str, Any]]:
+    """LATEST ポインタ（無ければ None）"""
+    raw = _read(uri, "LATEST")
+    return json.loads(raw) if raw else None
+
+
+def _advance_latest(uri: str, meta: Dict[str, Any]) -> bool:
+    """
+    LATEST を meta["version"] へ進める（既に同じか新しい版なら何もせず False）。
+    GCS では読んだ generation を条件に書き、別の書き手と衝突したら読み直してやり直す。
+    """
+    data = json.dumps(meta).encode("utf-8")
+    if not uri.startswith("gs://"):
+        import fcntl
+        os.makedirs(uri, exist_ok=True)
+        with open(os.path.join(uri, "LATEST.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if int((read_latest(uri) or {}).get("version", 0)) >= meta["version"]:
+                return False
+            _write(uri, "LATEST", data)
+            return True
+
+    from google.cloud import storage
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+    bucket, prefix = _split_gs(uri)
+    name = f"{prefix}/LATEST" if prefix else "LATEST"
+    b = storage.Client().bucket(bucket)
+    for _ in range(10):
+        try:
+            blob = b.get_blob(name)
+            generation, current = 0, 0               # generation=0: まだ無い時だけ作成
+            if blob is not None:
+                generation = blob.generation
+                current = int(json.loads(blob.download_as_bytes(if_generation_match=generation)).get("version", 0))
+            if current >= meta["version"]:
+                return False
+            b.blob(name).upload_from_string(data, if_generation_match=generation)
+            return True
+        except (PreconditionFailed, NotFound):
+            continue
+    raise RuntimeError("snapshot LATEST update conflict")
+
+
+def write_snapshot(uri: str, records: List[Dict[str, str]], embeddings: np.ndarray) -> int:
+    """records と embeddings（行順一致）を新しい版として書き、LATEST を進めて版番号を返す"""
+    arrays = {}
+    for col in COLUMNS:
+        arrays[f"{col}.data"], arrays[f"{col}.offsets"] = _pack_strings([r.get(col, "") for r in records])
+    arrays["summary_hash.data"], arrays["summary_hash.offsets"] = _pack_strings(
+        [summary_hash(r.get("summary", "")) for r in records]
+    )
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    columns_npz = buf.getvalue()
+
+    # 同時に走った別インスタンスと版番号がぶつかったら次の番号で取り直す
+    version = int((read_latest(uri) or {}).get("version", 0)) + 1
+    for _ in range(5):
+        try:
+            _write(uri, f"v{version:08d}/columns.npz", columns_npz, create_only=True)
+            break
+        except FileExistsError:
+            version += 1
+    else:
+        raise RuntimeError("snapshot version conflict")
+    vdir = f"v{version:08d}"
+
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(embeddings, dtype=np.float32))
+    _write(uri, f"{vdir}/embeddings.npy", buf.getvalue())
+
+    meta = {
+        "version": version,
+        "rows": len(records),
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "built_at": time.time(),
+    }
+    _advance_latest(uri, meta)   # 先に新しい版が出ていれば LATEST はそのまま
+    if version > KEEP_VERSIONS:
+        _delete_version(uri, version - KEEP_VERSIONS)
+    print(f"[Snapshot] wrote v{version} rows={meta['rows']} dim={meta['dim']}")
+    return version
+
+
+def load_snapshot(uri: str, version: int, cache_dir: str = "/tmp/job_snapshot") -> Dict[str, Any]:
+    """
+    指定版をローカルに落として開く。embeddings は np.load(mmap_mode="r") の memmap。
+    返り値: {"version", "records": [dict], "summary_hash": [str], "embeddings": memmap}
+    """
+    vdir = f"v{version:08d}"
+    if uri.startswith("gs://"):
+        base = os.path.join(cache_dir, vdir)
+        for name in ("columns.npz", "embeddings.npy"):
+            path = os.path.join(base, name)
+            if not os.path.exists(path):
+                data = _read(uri, f"{vdir}/{name}")
+                if data is None:
+                    raise FileNotFoundError(f"{uri}/{vdir}/{name}")
+                os.makedirs(base, exist_ok=True)
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(data)
+                os.replace(f"{path}.tmp", path)
+    else:
+        base = os.path.join(uri, vdir)
+
+    with np.load(os.path.join(base, "columns.npz")) as z:
+        cols = {col: _unpack_strings(z[f"{col}.data"], z[f"{col}.offsets"]) for col in COLUMNS}
+        hashes = _unpack_strings(z["summary_hash.data"], z["summary_hash.offsets"])
+    n = len(hashes)
+    records = [{col: cols[col][i] for col in COLUMNS} for i in range(n)]
+    # 空配列は mmap できないので通常読み込み
+    embeddings = np.load(os.path.join(base, "embeddings.npy"), mmap_mode="r" if n else None)
+    return {"version": version, "records": records, "summary_hash": hashes, "embeddings": embeddings}
+
+
+def refresh_snapshot(
+    uri: str,
+    rows: List[List[Any]],
+    embed_fn: Callable[[List[str]], Any],
+    cache_dir: str = "/tmp/job_snapshot",
+) -> Optional[int]:
+    """
+    Sheets の values（ヘッダー除外済み）を新しい版として書き、版番号を返す。
+    最新版と records が同じなら書かずに None。summary が同じ行は前回版の embedding を
+    使い回し、変わった行だけ embed_fn（空でない summary のリスト → [n, d]）で作る。
+    """
+    records = rows_to_records(rows)
+    hashes = [summary_hash(r["summary"]) for r in records]
+
+    prev_vecs: Dict[str, np.ndarray] = {}
+    latest = read_latest(uri)
+    if latest:
+        try:
+            prev = load_snapshot(uri, latest["version"], cache_dir)
+            if prev["records"] == records:
+                return None
+            prev_vecs = {h: prev["embeddings"][i] for i, h in enumerate(prev["summary_hash"])}
+        except Exception as e:
+            print(f"[Snapshot] previous v{latest['version']} unreadable ({e}); re-embed all")
+
+    def _embed(idx: List[int]) -> np.ndarray:
+        return np.asarray(embed_fn([records[i]["summary"] for i in idx]), dtype=np.float32)
+
+    todo = [i for i, h in enumerate(hashes) if h not in prev_vecs and records[i]["summary"].strip()]
+    fresh = _embed(todo) if todo else None
+    dim = next((len(v) for v in prev_vecs.values() if len(v)), 0)
+    if fresh is not None and dim and fresh.shape[1] != dim:
+        # モデル変更などで次元が変わったら全件作り直し
+        prev_vecs = {}
+        todo = [i for i, r in enumerate(records) if r["summary"].strip()]
+        fresh = _embed(todo)
+    if fresh is not None:
+        dim = fresh.shape[1]
+
+    embeddings = np.zeros((len(records), dim), dtype=np.float32)
+    for i, h in enumerate(hashes):
+        if h in prev_vecs and len(prev_vecs[h]) == dim:
+            embeddings[i] = prev_vecs[h]
+    if todo and dim:
+        embeddings[todo] = fresh
+    print(f"[Snapshot] rows={len(records)} embedded={len(todo)}")
+    return write_snapshot(uri, records, embeddings)
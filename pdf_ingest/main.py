@@ -1,28 +1,48 @@
 # ──────────────────────────────────────────────────────────────
 #  main.py  — Cloud Run (Functions Framework) entry-point
 #
-#   0.  GCS に置いた抽出プロンプトをロード      (PROMPT_GCS_PATH)
+#   0.  GCS に置いた抽出プロンプトをロード      (PROMPT_GCS_PATH / テナントごと)
 #   1.  Drive → GCS にアップされた PDF を受信   (Cloud Storage イベント)
+#        └ オブジェクト名の接頭辞（inbox_prefix）でテナント＝書き込み先シートを決める
 #   2.  Gemini で構造化 JSON を生成（リトライ & サイズ制限）
+#        └ 複数ポジションの PDF はページ範囲で分割し、並列に抽出してマージ
 #   3.  会社名 × ポジション名 をキーに
 #        ├ 既存行があれば UPDATE
 #        └ 無ければ APPEND（A 列連番を採番）
-#   4.  Google スプレッドシートへ反映
+#   4.  Google スプレッドシートへ反映（UPDATE は 1 回の batchUpdate、APPEND は 1 回の append）
+#   5.  Cloud Scheduler → sync_snapshots: シートの手修正を Job_Database スナップショットへ反映
+#        └ スナップショットの書き手は pdf_ingest だけ（match_api は読むだけ）
 # ──────────────────────────────────────────────────────────────
 import functions_framework
 import os, json, time, unicodedata, re, google.auth
 from googleapiclient.discovery import build
 from google.cloud import storage
 import google.generativeai as genai
+from pypdf import PdfReader, PdfWriter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import numpy as np
+from retry_policy import PermanentError, call_with_retry
+import job_snapshot
+import tenant_config
 
 # ─────────────────────────────
 # 0. 設定
 # ─────────────────────────────
-PROMPT_GCS_PATH = "scout-system-config/prompt-job-extract.txt"      # プロンプト置き場
-SPREADSHEET_ID  = "14zSdCGQ9OnPzdiMOjZzQeAYj259JyB5Jk_I19EAG4Y8"    # スプシ ID
+PROMPT_GCS_PATH = os.getenv("PROMPT_GCS_PATH", "scout-system-config/prompt-job-extract.txt")   # プロンプト置き場
+SPREADSHEET_ID  = os.getenv("SPREADSHEET_ID", "14zSdCGQ9OnPzdiMOjZzQeAYj259JyB5Jk_I19EAG4Y8")  # スプシ ID
 SHEET_NAME      = "Job_Database"                                    # タブ名
 PDF_MAX_BYTES   = 2 * 1024 * 1024                                   # 2 MiB 以上はスキップ
-MAX_RETRY       = 3                                                 # Gemini 呼び出しリトライ
+MAX_RETRY       = 3                                                 # Gemini 呼び出し最大試行回数
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))            # セグメント抽出の並列数
+JOB_SNAPSHOT_URI = os.getenv("JOB_SNAPSHOT_URI", "")               # 空ならスナップショットを書かない
+EMBED_MODEL     = "models/text-embedding-004"                       # match_api と同じモデル
+# テナント設定（TENANTS_CONFIG）。上の 3 つは "default" テナントの値
+TENANTS = tenant_config.load_tenants({
+    "sheet_id": SPREADSHEET_ID,
+    "snapshot_uri": JOB_SNAPSHOT_URI,
+    "prompt_gcs_path": PROMPT_GCS_PATH,
+})
 
 SCOPES = [
     "https://www.googleapis.com/auth/cloud-platform",
@@ -43,8 +63,16 @@ model           = genai.GenerativeModel("gemini-1.5-flash-latest")
 # ─────────────────────────────
 # 2. プロンプト読み込み（起動時 1 回）
 # ─────────────────────────────
-_bucket, _blob  = PROMPT_GCS_PATH.split("/", 1)
-PROMPT_BASE     = storage_client.bucket(_bucket).blob(_blob).download_as_text()
+_PROMPTS = {}
+
+def load_prompt(path: str) -> str:
+    """bucket/obj のプロンプトを読み、パスごとにキャッシュ"""
+    if path not in _PROMPTS:
+        bucket, blob = path.split("/", 1)
+        _PROMPTS[path] = storage_client.bucket(bucket).blob(blob).download_as_text()
+    return _PROMPTS[path]
+
+PROMPT_BASE     = load_prompt(PROMPT_GCS_PATH)
 
 # ─────────────────────────────
 # 3. ユーティリティ
@@ -56,21 +84,205 @@ def canon(txt: str) -> str:
     txt = re.sub(r"\s+", "", txt)
     return txt.lower()
 
-def ask_gemini(pdf: bytes) -> dict:
-    """Gemini に JSON 抽出をリトライ付きで依頼"""
-    prompt = PROMPT_BASE + "\n\n# 実行\n指示に従い JSON で返してください。"
-    for n in range(1, MAX_RETRY + 1):
+def tenant_for(file_name: str) -> tuple:
+    """オブジェクト名に一番長く一致する inbox_prefix のテナント（無ければ default）"""
+    hits = [
+        (len(conf["inbox_prefix"]), name) for name, conf in TENANTS.items()
+        if conf["inbox_prefix"] and file_name.startswith(conf["inbox_prefix"])
+    ]
+    name = max(hits)[1] if hits else tenant_config.DEFAULT_TENANT
+    return name, TENANTS[name]
+
+def ask_gemini(pdf: bytes, prompt_base: str = None) -> "dict | list":
+    """Gemini に JSON 抽出を依頼（429/5xx/タイムアウトのみ共通ポリシーで再試行）"""
+    prompt = (
+        (prompt_base or PROMPT_BASE)
+        + "\n\n# 実行\n指示に従い JSON で返してください。"
+        + "\n複数のポジションが含まれる場合は、同じ形式のオブジェクトの JSON 配列で返してください。"
+    )
+    resp = call_with_retry(
+        lambda: model.generate_content(
+            [prompt, {"mime_type": "application/pdf", "data": pdf}]
+        ),
+        key="pdf_ingest",
+        max_attempts=MAX_RETRY,
+        label="Gemini extract",
+    )
+    txt = resp.text.strip().removeprefix("```json").removesuffix("```")
+    try:
+        return json.loads(txt)
+    except json.JSONDecodeError as e:
+        # 形状不一致は再試行しても直らないので即失敗
+        raise PermanentError(f"Gemini returned non-JSON: {txt[:200]}") from e
+
+# 求人票 1 件の先頭ページに出やすい見出し
+_JOB_HEAD_RE = re.compile(
+    r"^\s*(募集職種|募集ポジション|ポジション名|職種名|求人票|job\s*title|position)\s*[:：]?",
+    re.M | re.I,
+)
+
+def segment_ranges(reader: PdfReader) -> list:
+    """求人の見出しページで区切った [start, end) のリスト。見出しが 2 つ未満なら PDF 全体で 1 つ"""
+    n = len(reader.pages)
+    if n <= 1:
+        return [(0, n)]
+    starts = [
+        i for i, page in enumerate(reader.pages)
+        if _JOB_HEAD_RE.search((page.extract_text() or "")[:300])
+    ]
+    if len(starts) >= 2:
+        if starts[0] != 0:
+            starts.insert(0, 0)
+        return list(zip(starts, starts[1:] + [n]))
+    # 境界が分からないのに機械的に割ると 1 求人が断片になるので、全体を渡して配列で返させる
+    return [(0, n)]
+
+def split_pdf(pdf: bytes) -> list:
+    """
+    PDF をセグメントごとの PDF bytes に分割。
+    pypdf で読めない PDF（壊れている・AES 暗号化で cryptography が要る等）は分割せず丸ごと Gemini へ渡す。
+    """
+    try:
+        reader = PdfReader(BytesIO(pdf))
+        ranges = segment_ranges(reader)
+        if len(ranges) == 1:
+            return [pdf]
+        parts = []
+        for start, end in ranges:
+            writer = PdfWriter()
+            for i in range(start, end):
+                writer.add_page(reader.pages[i])
+            buf = BytesIO()
+            writer.write(buf)
+            parts.append(buf.getvalue())
+        return parts
+    except Exception as e:
+        print(f"[Split] pypdf failed ({type(e).__name__}: {e}); send whole PDF")
+        return [pdf]
+
+def job_key(job: dict) -> tuple:
+    return (canon(job.get("company_name", "")), canon(job.get("position_name", "")))
+
+def extract_jobs(pdf: bytes, prompt_base: str = None) -> list:
+    """
+    セグメントを並列に抽出して求人リストにまとめる。
+    ページ分割で 1 求人が 2 セグメントに跨った場合は、同じキーの空欄を後続で補完する。
+    """
+    segments = split_pdf(pdf)
+    with ThreadPoolExecutor(max_workers=max(1, min(EXTRACT_WORKERS, len(segments)))) as pool:
+        futures = [pool.submit(ask_gemini, seg, prompt_base) for seg in segments]
+
+    # 失敗したセグメントだけ飛ばし、他のセグメントの求人は取り込む
+    results, errors = [], []
+    for n, fut in enumerate(futures, 1):
         try:
-            resp = model.generate_content(
-                [prompt, {"mime_type": "application/pdf", "data": pdf}]
-            )
-            return json.loads(resp.text.strip().removeprefix("```json").removesuffix("```"))
+            results.append(fut.result())
         except Exception as e:
-            if n == MAX_RETRY:
-                raise
-            backoff = 2 ** n
-            print(f"[Retry {n}] Gemini failed ({e}), sleep {backoff}s")
-            time.sleep(backoff)
+            errors.append(e)
+            print(f"[Skip] segment {n}/{len(segments)} failed: {e}")
+    if errors and not results:
+        raise errors[0]   # 全滅なら従来どおりファイル単位の失敗にする
+
+    merged = {}
+    for res in results:
+        for job in (res if isinstance(res, list) else [res]):
+            if not isinstance(job, dict) or not all(job_key(job)):
+                print(f"[Skip] segment job without company/position: {str(job)[:200]}")
+                continue
+            cur = merged.setdefault(job_key(job), {})
+            for k, v in job.items():
+                if v and not cur.get(k):
+                    cur[k] = v
+    print(f"[Extract] segments={len(segments)} jobs={len(merged)}")
+    return list(merged.values())
+
+def job_row(job: dict) -> list:
+    return [
+        job["job_id"],
+        job.get("company_name", ""),
+        job.get("position_name", ""),
+        job.get("status", "募集中"),
+        job.get("job_summary", ""),
+        job.get("work_location", ""),
+        job.get("salary_range", ""),
+        "\n".join(job.get("required_skills", [])),
+        "\n".join(job.get("preferred_skills", [])),
+        job.get("ideal_candidate_profile", ""),
+        "\n".join(job.get("appeal_points", [])),
+    ]
+
+def upsert_jobs(jobs: list, sheet_id: str = SPREADSHEET_ID) -> list:
+    """
+    会社名 × ポジション名 で UPDATE / APPEND を振り分ける。
+    既存行は 1 回の batchUpdate、新規行は 1 回の append（追記先の行は Sheets 側が決める）
+    """
+    sheet  = sheets_service.spreadsheets()
+    values = sheet.values().get(
+        spreadsheetId=sheet_id, range=f"{SHEET_NAME}!A:C"
+    ).execute().get("values", [])
+    header, rows = (values[0], values[1:]) if values else ([], [])
+
+    key_map = {
+        (canon(r[1]), canon(r[2])): idx + 2      # 1 行目はヘッダー
+        for idx, r in enumerate(rows) if len(r) >= 3
+    }
+    next_id = max((int(r[0]) for r in rows if r and r[0].isdigit()), default=0) + 1
+
+    updates, appends = [], []
+    for job in jobs:
+        row_idx = key_map.get(job_key(job))
+        if row_idx:
+            job["job_id"] = rows[row_idx - 2][0] or "0"
+            updates.append({"range": f"{SHEET_NAME}!A{row_idx}:K{row_idx}", "values": [job_row(job)]})
+            print(f"[Update] id={job['job_id']} row={row_idx}")
+        else:
+            job["job_id"] = str(next_id)
+            next_id += 1
+            appends.append(job_row(job))
+            print(f"[Append] id={job['job_id']}")
+
+    if updates:
+        sheet.values().batchUpdate(
+            spreadsheetId=sheet_id,
+            body={"valueInputOption": "USER_ENTERED", "data": updates},
+        ).execute()
+    if appends:
+        sheet.values().append(
+            spreadsheetId=sheet_id,
+            range=f"{SHEET_NAME}!A1",
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body={"values": appends},
+        ).execute()
+    return [job["job_id"] for job in jobs]
+
+def embed_summaries(texts: list) -> np.ndarray:
+    """summary を 100 件ずつ embedding（空文字はゼロベクトル）"""
+    idx = [i for i, t in enumerate(texts) if t.strip()]
+    vecs = []
+    for i in range(0, len(idx), 100):
+        chunk = [texts[k] for k in idx[i:i + 100]]
+        res = call_with_retry(
+            lambda: genai.embed_content(model=EMBED_MODEL, content=chunk),
+            key="pdf_ingest",
+            label="Embed summaries",
+        )
+        vecs.extend(res["embedding"])
+    dim = len(vecs[0]) if vecs else 0
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    if vecs:
+        out[idx] = np.array(vecs, dtype=np.float32)
+    return out
+
+def refresh_snapshot(sheet_id: str = SPREADSHEET_ID, uri: str = JOB_SNAPSHOT_URI) -> "int | None":
+    """
+    Job_Database!A:K を読み直して列指向スナップショットを書き出す（内容が同じなら書かない）。
+    前回版と summary が同じ行は embedding を使い回し、変わった行だけ embedding する。
+    """
+    values = sheets_service.spreadsheets().values().get(
+        spreadsheetId=sheet_id, range=f"{SHEET_NAME}!A:K"
+    ).execute().get("values", [])
+    return job_snapshot.refresh_snapshot(uri, values[1:], embed_summaries)
 
 # ─────────────────────────────
 # 4. Cloud Storage → Cloud Run ハンドラ
@@ -90,66 +302,49 @@ def process_storage_event(cloud_event):
             print(f"[Skip] {file_name} too large ({blob.size} bytes)")
             return "File too large", 200
 
-        print(f"[Start] {file_name}")
+        tenant, conf = tenant_for(file_name)
+        print(f"[Start] {file_name} tenant={tenant}")
         pdf_bytes = blob.download_as_bytes()
 
-        job = ask_gemini(pdf_bytes)
+        prompt_base = load_prompt(conf["prompt_gcs_path"] or PROMPT_GCS_PATH)
+        jobs = extract_jobs(pdf_bytes, prompt_base)
+        if not jobs:
+            print(f"[Skip] {file_name} no jobs extracted")
+            return "No jobs", 200
 
-        # 既存行を読み込む
-        sheet  = sheets_service.spreadsheets()
-        values = sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID, range=f"{SHEET_NAME}!A:C"
-        ).execute().get("values", [])
-        header, rows = (values[0], values[1:]) if values else ([], [])
+        ids = upsert_jobs(jobs, conf["sheet_id"])
+        print(f"[Done] {file_name} ids={ids}")
 
-        key_map = {
-            (canon(r[1]), canon(r[2])): idx + 2      # 1 行目はヘッダー
-            for idx, r in enumerate(rows) if len(r) >= 3
-        }
-        key = (canon(job["company_name"]), canon(job["position_name"]))
-        row_idx = key_map.get(key)
-
-        # Job_ID 決定
-        if row_idx:
-            job["job_id"] = rows[row_idx - 2][0] or "0"
-        else:
-            ids = [int(r[0]) for r in rows if r and r[0].isdigit()]
-            job["job_id"] = str(max(ids, default=0) + 1)
-
-        # 行データ整形
-        row = [
-            job["job_id"],
-            job.get("company_name", ""),
-            job.get("position_name", ""),
-            job.get("status", "募集中"),
-            job.get("job_summary", ""),
-            job.get("work_location", ""),
-            job.get("salary_range", ""),
-            "\n".join(job.get("required_skills", [])),
-            "\n".join(job.get("preferred_skills", [])),
-            job.get("ideal_candidate_profile", ""),
-            "\n".join(job.get("appeal_points", [])),
-        ]
-
-        if row_idx:
-            sheet.values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A{row_idx}:K{row_idx}",
-                valueInputOption="USER_ENTERED",
-                body={"values": [row]},
-            ).execute()
-            print(f"[Update] id={job['job_id']} row={row_idx}")
-        else:
-            sheet.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A1",
-                valueInputOption="USER_ENTERED",
-                body={"values": [row]},
-            ).execute()
-            print(f"[Append] id={job['job_id']}")
+        # スナップショット更新の失敗で取り込み自体は失敗扱いにしない
+        if conf["snapshot_uri"]:
+            try:
+                refresh_snapshot(conf["sheet_id"], conf["snapshot_uri"])
+            except Exception as e:
+                print(f"[Snapshot] refresh failed: {e}")
 
         return "OK", 200
 
     except Exception as e:
         print(f"[Error] {e}")
         return f"Error: {e}", 500
+
+# ─────────────────────────────
+# 5. Cloud Scheduler → スナップショット同期（HTTP）
+# ─────────────────────────────
+@functions_framework.http
+def sync_snapshots(request):
+    """
+    テナントごとに Job_Database を読み直し、スナップショットと違えば新しい版を書く。
+    PDF を経由しない手修正（募集終了・給与訂正など）を match_api に届けるため数分おきに呼ぶ。
+    """
+    results, failed = {}, False
+    for tenant, conf in TENANTS.items():
+        if not conf["snapshot_uri"]:
+            continue
+        try:
+            results[tenant] = refresh_snapshot(conf["sheet_id"], conf["snapshot_uri"])
+        except Exception as e:
+            print(f"[Snapshot] {tenant} sync failed: {e}")
+            results[tenant], failed = f"error: {e}", True
+    print(f"[Snapshot] sync {results}")
+    return json.dumps(results), 500 if failed else 200
@@ -0,0 +1,58 @@
+# tenant_config.py – 採用チーム（テナント）ごとのスプレッドシート / GCS 設定
+#
+#   match_api / pdf_ingest はそれぞれ単体ディレクトリで Cloud Run にデプロイするため、
+#   両方に同じ内容のファイルを置いている（ずれは .github/workflows/shared-modules.yml が検出）。
+#
+#   TENANTS_CONFIG = インライン JSON / gs://bucket/obj / ローカルパス
+#     {
+#       "team-a": {
+#         "sheet_id": "1AbC…",                       # 必須
+#         "snapshot_uri": "gs://…/job_snapshot/team-a",
+#         "precompute_path": "gs://…/match_topk.team-a.npz",
+#         "prompt_gcs_path": "bucket/prompt-job-extract.txt",
+#         "inbox_prefix": "team-a/"                  # pdf_ingest: このパス配下の PDF を振り分け
+#       },
+#       …
+#     }
+#   "default" は各サービスの従来 env（SPREADSHEET_ID など）から作り、設定ファイル側で上書きできる。
+import os
+import json
+from typing import Dict
+
+DEFAULT_TENANT = "default"
+FIELDS = ("sheet_id", "snapshot_uri", "precompute_path", "prompt_gcs_path", "inbox_prefix")
+
+
+def _read_config(src: str) -> str:
+    if src.startswith("{"):
+        return src
+    if src.startswith("gs://"):
+        from google.cloud import storage
+        bucket, blob = src[5:].split("/", 1)
+        return storage.Client().bucket(bucket).blob(blob).download_as_text()
+    with open(src, encoding="utf-8") as f:
+        return f.read()
+
+
+def load_tenants(defaults: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    """
+    {テナント名: {FIELDS…}} を返す。defaults は "default" テナントの初期値。
+    sheet_id の無いテナント定義は設定ミスなので ValueError。
+    """
+    tenants = {DEFAULT_TENANT: {f: defaults.get(f, "") for f in FIELDS}}
+    src = os.getenv("TENANTS_CONFIG", "").strip()
+    if not src:
+        return tenants
+
+    raw = json.loads(_read_config(src))
+    if not isinstance(raw, dict):
+        raise ValueError("TENANTS_CONFIG must be a JSON object")
+    for name, conf in raw.items():
+        if not isinstance(conf, dict):
+            raise ValueError(f"tenant {name}: config must be an object")
+        base = tenants.get(name, {f: "" for f in FIELDS})
+        merged = {f: str(conf.get(f) or base[f]) for f in FIELDS}
+        if not merged["sheet_id"]:
+            raise ValueError(f"tenant {name}: sheet_id required")
+        tenants[name] = merged
+    return tenants